@@ -3,14 +3,16 @@ Modified from: https://github.com/facebookresearch/votenet/blob/master/scannet/b
 
 Batch mode in loading Scannet scenes with vertices and ground truth labels for semantic and instance segmentations
 
-Usage example: python ./batch_load_scannet_data.py
+Usage example: python ./batch_load_scannet_data.py [--archive scannet_data.s2c [--quantize] [--archive_only]]
 """
 
 import os
 import sys
+import argparse
 import datetime
 import numpy as np
 from load_scannet_data import export
+from scannet_archive import write_archive
 import pdb
 
 SCANNET_DIR = 'scans'
@@ -70,4 +72,15 @@ def batch_export():
         print('-'*20+'done')
 
 if __name__=='__main__':    
-    batch_export()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--archive', type=str, help='Also pack all exported scans into this single archive file.', default=None)
+    parser.add_argument('--quantize', action='store_true', help='Store xyz and normals as float16 in the archive.')
+    parser.add_argument('--archive_only', action='store_true', help='Only pack already exported scans, do not export again.')
+    args = parser.parse_args()
+
+    if not args.archive_only:
+        batch_export()
+
+    if args.archive is not None:
+        print('packing {} scans into {}'.format(len(SCAN_NAMES), args.archive))
+        write_archive(args.archive, SCAN_NAMES, OUTPUT_FOLDER, quantize=args.quantize)
@@ -0,0 +1,192 @@
+"""
+Consolidated archive for the preprocessed ScanNet scenes.
+
+Instead of four .npy files per scan, all scenes are packed into one file:
+
+    magic (8 bytes) | header length (uint64) | json header | column blocks
+
+Every column (xyz, rgb, normal, sem_label, ins_label, bbox) is stored as one contiguous
+block over all scenes, so a loader that only needs xyz + rgb never reads the normals.
+The header holds the dtype and byte offset of each column block and the row range of each scene.
+
+Derived per-scene data the loaders would otherwise recompute for every sample is stored as well:
+the normalized colors as column "color" and the floor height in the scene header.
+
+Usage example: python ./batch_load_scannet_data.py --archive scannet_data.s2c [--quantize]
+"""
+
+import os
+import json
+import struct
+import numpy as np
+
+MAGIC = b"S2CARCH1"
+ALIGNMENT = 64
+MEAN_COLOR_RGB = np.array([109.8, 97.2, 83.8])
+
+# table -> column -> (source columns, full precision dtype, quantized dtype)
+LAYOUT = {
+    "vertex": {
+        "xyz": (slice(0, 3), "float32", "float16"),
+        "rgb": (slice(3, 6), "uint8", "uint8"),
+        "color": (slice(3, 6), "float32", "float16"),
+        "normal": (slice(6, 9), "float32", "float16"),
+        "sem_label": (None, "int16", "int16"),
+        "ins_label": (None, "int16", "int16"),
+    },
+    "bbox": {
+        "bbox": (None, "float32", "float32"),
+    }
+}
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _load_scan(data_dir, scan_name, mmap_mode="r"):
+    prefix = os.path.join(data_dir, scan_name)
+    vert = np.load(prefix + "_vert.npy", mmap_mode=mmap_mode)
+    scan = {
+        "xyz": vert,
+        "rgb": vert,
+        "color": vert,
+        "normal": vert,
+        "sem_label": np.load(prefix + "_sem_label.npy", mmap_mode=mmap_mode),
+        "ins_label": np.load(prefix + "_ins_label.npy", mmap_mode=mmap_mode),
+        "bbox": np.load(prefix + "_bbox.npy", mmap_mode=mmap_mode),
+    }
+
+    return scan
+
+
+def floor_height(xyz):
+    """
+    Height of the floor, the 0.99th percentile of z over the whole scene.
+    """
+    return float(np.percentile(xyz[:, 2].astype(np.float64), 0.99))
+
+
+def _column_data(name, data, source, count):
+    if source is None:
+        return data.reshape(count, -1)
+    if name == "color":
+        return (data[:, source] - MEAN_COLOR_RGB) / 256.0
+
+    return data[:, source]
+
+
+def write_archive(path, scan_names, data_dir, quantize=False):
+    """
+    Pack the <scan>_{vert,sem_label,ins_label,bbox}.npy files of data_dir into one archive.
+
+    :param path: output file
+    :param scan_names: scans to pack, in order
+    :param data_dir: folder with the exported .npy files
+    :param quantize: store xyz, normals and normalized colors as float16 (rgb is always stored as uint8)
+    """
+    # first pass: row counts and floor height per scene
+    scenes = {}
+    rows = {table: 0 for table in LAYOUT}
+    for scan_name in scan_names:
+        scan = _load_scan(data_dir, scan_name)
+        scenes[scan_name] = {}
+        for table, key in [("vertex", "xyz"), ("bbox", "bbox")]:
+            count = scan[key].shape[0]
+            scenes[scan_name][table] = [rows[table], count]
+            rows[table] += count
+        scenes[scan_name]["floor_height"] = floor_height(scan["xyz"])
+
+    # column blocks
+    columns = {}
+    offset = 0
+    for table, table_columns in LAYOUT.items():
+        for name, (source, dtype, quantized_dtype) in table_columns.items():
+            dtype = quantized_dtype if quantize else dtype
+            if source is not None:
+                width = source.stop - source.start
+            elif name == "bbox":
+                width = 8
+            else:
+                width = 1
+            columns[name] = {"table": table, "dtype": dtype, "width": width, "offset": offset}
+            offset = _align(offset + rows[table] * width * np.dtype(dtype).itemsize)
+
+    header = json.dumps({"columns": columns, "scenes": scenes, "quantized": quantize}).encode("utf-8")
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        f.truncate(data_start + offset)
+
+    # second pass: fill the column blocks
+    for name, column in columns.items():
+        table = column["table"]
+        block = np.memmap(path, dtype=column["dtype"], mode="r+", offset=data_start + column["offset"], shape=(rows[table], column["width"]))
+        source = LAYOUT[table][name][0]
+        for scan_name in scan_names:
+            start, count = scenes[scan_name][table]
+            data = _load_scan(data_dir, scan_name)[name]
+            block[start:start + count] = _column_data(name, data, source, count)
+        block.flush()
+        del block
+
+
+class SceneArchive():
+    """
+    Read-only, memory-mapped view of an archive written by write_archive().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._open()
+
+    def __contains__(self, scene_id):
+        return scene_id in self.scenes
+
+    def __getstate__(self):
+        # reopen the memmaps instead of pickling their content
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._open()
+
+    def _open(self):
+        with open(self.path, "rb") as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError("{} is not a scene archive".format(self.path))
+            header_len = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(header_len).decode("utf-8"))
+
+        data_start = _align(len(MAGIC) + 8 + header_len)
+        self.columns = header["columns"]
+        self.scenes = header["scenes"]
+        self.quantized = header["quantized"]
+
+        self._blocks = {}
+        for name, column in self.columns.items():
+            rows = sum(scene[column["table"]][1] for scene in self.scenes.values())
+            self._blocks[name] = np.memmap(self.path, dtype=column["dtype"], mode="r", offset=data_start + column["offset"], shape=(rows, column["width"]))
+
+    def floor_height(self, scene_id):
+        """
+        Stored floor height of one scene, None for archives written without it.
+        """
+        return self.scenes[scene_id].get("floor_height")
+
+    def get(self, scene_id, column):
+        """
+        Rows of one column for one scene, as a read-only memmap in the stored dtype.
+        Single-width label columns are returned as 1-d arrays.
+        """
+        table = self.columns[column]["table"]
+        start, count = self.scenes[scene_id][table]
+        data = self._blocks[column][start:start + count]
+        if column in ["sem_label", "ins_label"]:
+            data = data[:, 0]
+
+        return data
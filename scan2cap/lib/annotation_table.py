@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+
+sys.path.append(os.path.join(os.getcwd(), "lib")) # HACK add the lib folder
+from lib.config import CONF
+
+TABLE_VERSION = 2
+
+
+class AnnotationTable():
+    """
+    Columnar, pre-tokenized view of a ScanRefer split.
+
+    Instead of a list of dicts with token strings, the table keeps flat numpy arrays:
+    scene/object/annotation ids (int32), the token ids of all descriptions packed CSR-style
+    (token_offsets + token_ids) and the annotations of the same object grouped the same way
+    (group_offsets + group_members). Lookups in __getitem__ become array slicing, and the workers
+    no longer touch (and copy-on-write) millions of Python objects.
+
+    The table is built once per (split, vocabulary) and cached under CONF.PATH.CACHE.
+    Unknown tokens map to index 0, like the defaultdict the dataset used before, the raw
+    tokens are kept as indices into the words of the split (word_ids, same offsets).
+    """
+
+    def __init__(self, scanrefer, vocabulary, cache_dir=None):
+        self.vocabulary = vocabulary
+        self.cache_dir = cache_dir if cache_dir is not None else CONF.PATH.CACHE
+
+        cache_path = os.path.join(self.cache_dir, "scanrefer_{}.npz".format(self._cache_key(scanrefer, vocabulary)))
+        if os.path.exists(cache_path):
+            columns = dict(np.load(cache_path))
+        else:
+            columns = self._build(scanrefer, vocabulary)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            np.savez(cache_path, **columns)
+
+        self.scene_list = columns["scene_list"].tolist()
+        self.object_names = columns["object_names"].tolist()
+        self.scene_idx = columns["scene_idx"]
+        self.object_ids = columns["object_ids"]
+        self.ann_ids = columns["ann_ids"]
+        self.object_name_idx = columns["object_name_idx"]
+        self.token_offsets = columns["token_offsets"]
+        self.token_ids = columns["token_ids"]
+        self.words = columns["words"].tolist()
+        self.word_ids = columns["word_ids"]
+        self.group_idx = columns["group_idx"]
+        self.group_offsets = columns["group_offsets"]
+        self.group_members = columns["group_members"]
+        self.end_index = int(columns["end_index"])
+
+    def __len__(self):
+        return self.scene_idx.shape[0]
+
+    def scene_id(self, idx):
+        return self.scene_list[self.scene_idx[idx]]
+
+    def object_name(self, idx):
+        return self.object_names[self.object_name_idx[idx]]
+
+    def tokens(self, idx):
+        return self.token_ids[self.token_offsets[idx]:self.token_offsets[idx + 1]]
+
+    def raw_tokens(self, idx):
+        """
+        Tokens of description idx as strings, including the ones outside the vocabulary.
+        """
+        return [self.words[i] for i in self.word_ids[self.token_offsets[idx]:self.token_offsets[idx + 1]]]
+
+    def group(self, idx):
+        """
+        Indices of all annotations describing the same object as idx (including idx itself).
+        """
+        group = self.group_idx[idx]
+        return self.group_members[self.group_offsets[group]:self.group_offsets[group + 1]]
+
+    def num_groups(self):
+        return self.group_offsets.shape[0] - 1
+
+    def padded(self, max_len):
+        """
+        All descriptions as one (num_annotations, max_len) matrix, cut to max_len - 1 tokens,
+        terminated by <end> and padded with -1, plus the resulting lengths (including <end>).
+        """
+        num_tokens = np.diff(self.token_offsets)
+        lengths = np.minimum(num_tokens + 1, max_len)
+
+        indices = np.full((len(self), max_len), -1, dtype=np.int64)
+        rows = np.repeat(np.arange(len(self)), lengths - 1)
+        starts = np.repeat(np.cumsum(lengths - 1) - (lengths - 1), lengths - 1)
+        cols = np.arange(rows.shape[0]) - starts
+        indices[rows, cols] = self.token_ids[self.token_offsets[rows] + cols]
+        indices[np.arange(len(self)), lengths - 1] = self.end_index
+
+        return indices, lengths.astype(np.int64)
+
+    def _cache_key(self, scanrefer, vocabulary):
+        # everything the table is built from, so re-tokenized or renamed annotations rebuild it
+        sha = hashlib.sha1()
+        sha.update(json.dumps([TABLE_VERSION, vocabulary]).encode("utf-8"))
+        for data in scanrefer:
+            sha.update(json.dumps([data["scene_id"], data["object_id"], data["ann_id"], data["object_name"], data["token"]]).encode("utf-8"))
+
+        return sha.hexdigest()
+
+    def _build(self, scanrefer, vocabulary):
+        vocab2index = {v: i for i, v in enumerate(vocabulary)}
+        scene_list = sorted(list(set([data["scene_id"] for data in scanrefer])))
+        scene2idx = {scene_id: i for i, scene_id in enumerate(scene_list)}
+        object_names = sorted(list(set([data["object_name"] for data in scanrefer])))
+        name2idx = {name: i for i, name in enumerate(object_names)}
+
+        num = len(scanrefer)
+        scene_idx = np.zeros(num, dtype=np.int32)
+        object_ids = np.zeros(num, dtype=np.int32)
+        ann_ids = np.zeros(num, dtype=np.int32)
+        object_name_idx = np.zeros(num, dtype=np.int32)
+        token_offsets = np.zeros(num + 1, dtype=np.int64)
+        token_ids = []
+        word2idx = {}
+        word_ids = []
+
+        # annotations of the same (scene, object), in order of first appearance
+        group_idx = np.zeros(num, dtype=np.int32)
+        group2idx = {}
+        groups = []
+        for i, data in enumerate(scanrefer):
+            scene_idx[i] = scene2idx[data["scene_id"]]
+            object_ids[i] = int(data["object_id"])
+            ann_ids[i] = int(data["ann_id"])
+            object_name_idx[i] = name2idx[data["object_name"]]
+
+            tokens = [vocab2index.get(t, 0) for t in data["token"]]
+            token_ids.extend(tokens)
+            word_ids.extend([word2idx.setdefault(t, len(word2idx)) for t in data["token"]])
+            token_offsets[i + 1] = token_offsets[i] + len(tokens)
+
+            key = (data["scene_id"], int(data["object_id"]))
+            if key not in group2idx:
+                group2idx[key] = len(groups)
+                groups.append([])
+            group_idx[i] = group2idx[key]
+            groups[group_idx[i]].append(i)
+
+        group_offsets = np.zeros(len(groups) + 1, dtype=np.int64)
+        group_offsets[1:] = np.cumsum([len(members) for members in groups])
+        group_members = np.array([i for members in groups for i in members], dtype=np.int32)
+
+        token_dtype = np.int16 if len(vocabulary) < 2 ** 15 else np.int32
+
+        return {
+            "scene_list": np.array(scene_list),
+            "object_names": np.array(object_names),
+            "scene_idx": scene_idx,
+            "object_ids": object_ids,
+            "ann_ids": ann_ids,
+            "object_name_idx": object_name_idx,
+            "token_offsets": token_offsets,
+            "token_ids": np.array(token_ids, dtype=token_dtype),
+            "words": np.array(sorted(word2idx, key=word2idx.get)),
+            "word_ids": np.array(word_ids, dtype=np.int32),
+            "group_idx": group_idx,
+            "group_offsets": group_offsets,
+            "group_members": group_members,
+            "end_index": np.array(vocab2index.get("<end>", 0))
+        }
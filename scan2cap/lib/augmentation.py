@@ -0,0 +1,176 @@
+import os
+import sys
+import math
+import torch
+import numpy as np
+
+sys.path.append(os.path.join(os.getcwd(), "lib")) # HACK add the lib folder
+from utils.pc_utils import rotx, roty, rotz
+from data.scannet.model_util_scannet import rotate_aligned_boxes_along_axis
+
+TRANSLATION_FACTORS = np.arange(-0.5, 0.501, 0.001)
+
+
+def augment_point_cloud(point_cloud, target_bboxes, rng=np.random):
+    """
+    Per-sample augmentation of the datasets: random flips along the YZ and XZ planes, rotations
+    of -5 ~ +5 degree along x, y and z, and a translation of up to 0.5 in every direction.
+
+    :param point_cloud: (N, C) array, only xyz is transformed (in place)
+    :param target_bboxes: (M, 6) array of axis aligned boxes (center, size)
+    :param rng: np.random or a np.random.RandomState
+    :return: augmented point cloud and boxes
+    """
+    if rng.random_sample() > 0.5:
+        # Flipping along the YZ plane
+        point_cloud[:,0] = -1 * point_cloud[:,0]
+        target_bboxes[:,0] = -1 * target_bboxes[:,0]
+
+    if rng.random_sample() > 0.5:
+        # Flipping along the XZ plane
+        point_cloud[:,1] = -1 * point_cloud[:,1]
+        target_bboxes[:,1] = -1 * target_bboxes[:,1]
+
+    # Rotation along X-axis
+    rot_angle = (rng.random_sample()*np.pi/18) - np.pi/36 # -5 ~ +5 degree
+    rot_mat = rotx(rot_angle)
+    point_cloud[:,0:3] = np.dot(point_cloud[:,0:3], np.transpose(rot_mat))
+    target_bboxes = rotate_aligned_boxes_along_axis(target_bboxes, rot_mat, "x")
+
+    # Rotation along Y-axis
+    rot_angle = (rng.random_sample()*np.pi/18) - np.pi/36 # -5 ~ +5 degree
+    rot_mat = roty(rot_angle)
+    point_cloud[:,0:3] = np.dot(point_cloud[:,0:3], np.transpose(rot_mat))
+    target_bboxes = rotate_aligned_boxes_along_axis(target_bboxes, rot_mat, "y")
+
+    # Rotation along up-axis/Z-axis
+    rot_angle = (rng.random_sample()*np.pi/18) - np.pi/36 # -5 ~ +5 degree
+    rot_mat = rotz(rot_angle)
+    point_cloud[:,0:3] = np.dot(point_cloud[:,0:3], np.transpose(rot_mat))
+    target_bboxes = rotate_aligned_boxes_along_axis(target_bboxes, rot_mat, "z")
+
+    # Translation
+    factor = [rng.choice(TRANSLATION_FACTORS, size=1)[0] for _ in range(3)]
+    point_cloud[:, :3] += factor
+    target_bboxes[:, :3] += factor
+
+    return point_cloud, target_bboxes
+
+
+def _rotation(axis, angles):
+    """
+    Batched rotx / roty / rotz from utils/pc_utils.py.
+
+    :param angles: (B,) tensor
+    :return: (B, 3, 3) tensor
+    """
+    c, s = torch.cos(angles), torch.sin(angles)
+    one, zero = torch.ones_like(angles), torch.zeros_like(angles)
+    if axis == "x":
+        rows = [one, zero, zero, zero, c, -s, zero, s, c]
+    elif axis == "y":
+        rows = [c, zero, s, zero, one, zero, -s, zero, c]
+    else:
+        rows = [c, -s, zero, s, c, zero, zero, zero, one]
+
+    return torch.stack(rows, 1).view(-1, 3, 3)
+
+
+def _rotate_box_sizes(sizes, rot_mat, axis):
+    """
+    Batched size update of rotate_aligned_boxes_along_axis in data/scannet/model_util_scannet.py,
+    including its corner layout, so boxes match the per-sample augmentation exactly.
+
+    :param sizes: (B, N, 3) tensor
+    :param rot_mat: (B, 3, 3) tensor
+    """
+    if axis == "x":
+        d1, d2 = sizes[..., 1] / 2.0, sizes[..., 2] / 2.0
+    elif axis == "y":
+        d1, d2 = sizes[..., 0] / 2.0, sizes[..., 2] / 2.0
+    else:
+        d1, d2 = sizes[..., 0] / 2.0, sizes[..., 1] / 2.0
+
+    # corners (-1,-1), (1,-1), (1,1), (-1,1) in the first two coordinates, (B, N, 4, 3)
+    signs = sizes.new_tensor([[-1, -1], [1, -1], [1, 1], [-1, 1]])
+    corners = torch.zeros(sizes.shape[:2] + (4, 3), device=sizes.device, dtype=sizes.dtype)
+    corners[..., 0] = signs[:, 0] * d1.unsqueeze(-1)
+    corners[..., 1] = signs[:, 1] * d2.unsqueeze(-1)
+    corners = torch.matmul(corners, rot_mat.transpose(1, 2).unsqueeze(1))
+    new_d1 = 2.0 * corners[..., 0].max(-1)[0]
+    new_d2 = 2.0 * corners[..., 1].max(-1)[0]
+
+    if axis == "x":
+        return torch.stack([sizes[..., 0], new_d1, new_d2], -1)
+    elif axis == "y":
+        return torch.stack([new_d1, sizes[..., 1], new_d2], -1)
+    else:
+        return torch.stack([new_d1, new_d2, sizes[..., 2]], -1)
+
+
+class BatchAugmentation():
+    """
+    The flip / rotate / translate augmentation of the datasets, applied to a collated batch
+    on whatever device it lives on.
+
+    Per sample the two flips and the three rotations are composed into one 3x3 matrix, so the points
+    of the whole batch are transformed with a single batched matmul. Only xyz is transformed,
+    like in augment_point_cloud(). Use it with datasets created with augment=False.
+    """
+
+    def __init__(self, max_angle=math.pi / 36, max_translation=0.5):
+        self.max_angle = max_angle
+        self.max_translation = max_translation
+
+    def __call__(self, data_dict):
+        point_clouds = data_dict["point_clouds"]
+        batch_size = point_clouds.shape[0]
+        device = point_clouds.device
+
+        # flipping along the YZ and XZ planes
+        flips = torch.ones(batch_size, 3, device=device)
+        flips[:, :2] = torch.where(torch.rand(batch_size, 2, device=device) > 0.5, -flips[:, :2], flips[:, :2])
+
+        # rotations along x, y and the up-axis, -5 ~ +5 degree each
+        angles = torch.rand(batch_size, 3, device=device) * 2 * self.max_angle - self.max_angle
+
+        # translation in steps of 1mm
+        steps = int(round(self.max_translation * 1000))
+        translation = torch.randint(-steps, steps + 1, (batch_size, 3), device=device).float() / 1000
+
+        return self.apply(data_dict, flips, angles, translation)
+
+    def apply(self, data_dict, flips, angles, translation):
+        """
+        :param flips: (B, 3) signs per axis
+        :param angles: (B, 3) rotation angles around x, y and z, applied in this order
+        :param translation: (B, 3)
+        """
+        rot_mat = torch.diag_embed(flips)
+        rotations = [_rotation(axis, angles[:, i]) for i, axis in enumerate(["x", "y", "z"])]
+        for rotation in rotations:
+            rot_mat = torch.bmm(rotation, rot_mat)
+
+        point_clouds = data_dict["point_clouds"]
+        xyz = torch.bmm(point_clouds[:, :, 0:3], rot_mat.transpose(1, 2)) + translation.unsqueeze(1)
+        data_dict["point_clouds"] = torch.cat([xyz, point_clouds[:, :, 3:]], 2)
+
+        # batches from SceneBatchSampler hold one point cloud per scene, its objects share the transform
+        if "scene_inds" in data_dict:
+            scene_inds = data_dict["scene_inds"]
+            rot_mat, translation = rot_mat[scene_inds], translation[scene_inds]
+            rotations = [rotation[scene_inds] for rotation in rotations]
+
+        # boxes: centers with the composed transform, sizes rotation by rotation
+        centers = torch.bmm(rot_mat, data_dict["ref_center_label"].unsqueeze(2)).squeeze(2) + translation
+        sizes = data_dict["ref_size_residual_label"].unsqueeze(1)
+        for axis, rotation in zip(["x", "y", "z"], rotations):
+            sizes = _rotate_box_sizes(sizes, rotation, axis)
+        sizes = sizes.squeeze(1)
+
+        data_dict["ref_center_label"] = centers
+        data_dict["ref_size_residual_label"] = sizes
+        if "ref_box_label" in data_dict:
+            data_dict["ref_box_label"] = torch.cat([centers, sizes], 1).unsqueeze(1).long()
+
+        return data_dict
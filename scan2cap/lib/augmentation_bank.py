@@ -0,0 +1,129 @@
+"""
+Offline augmentation bank: K pre-sampled, pre-augmented variants per scene.
+
+Layout of a bank folder:
+
+    meta.json              flags the bank was built with (num_points, use_color, ...)
+    <scene>_points.npy     (K, num_points, C) float32 point clouds, ready for the model
+    <scene>_color.npy      (K, num_points, 3) float32 colors of the sampled points
+    <scene>_bbox.npy       (K, num_boxes, 8) boxes, transformed along with each variant
+
+Build one with scripts/build_augmentation_bank.py and pass it to the datasets as augment_bank,
+every visit of a scene then picks one of its variants instead of sampling and augmenting.
+"""
+
+import os
+import sys
+import json
+import h5py
+import numpy as np
+
+sys.path.append(os.path.join(os.getcwd(), "lib")) # HACK add the lib folder
+from lib.scene_store import sample_choices, gather_point_cloud
+from lib.augmentation import augment_point_cloud
+
+BANK_META = "meta.json"
+BANK_FLAGS = ["num_points", "use_color", "use_normal", "use_multiview", "use_height"]
+
+
+def write_bank(path, scene_store, num_variants, num_points=40000, use_color=False, use_normal=False, use_height=False,
+               multiview_path=None, augment=True):
+    """
+    Write num_variants sampled (and augmented) variants of every scene in scene_store.
+
+    :param path: output folder
+    :param scene_store: SceneStore with the scenes to write, needs the columns for the requested features
+    :param multiview_path: enet_feats.hdf5 to gather the multiview features from, or None
+    :param augment: apply the random flips / rotations / translation of the datasets
+    """
+    os.makedirs(path, exist_ok=True)
+    multiview_data = h5py.File(multiview_path, "r", libver="latest") if multiview_path is not None else None
+
+    for scene_id in scene_store.scene_list:
+        scene = scene_store[scene_id]
+        instance_bboxes = np.array(scene_store.get_bboxes(scene_id))
+        multiview = multiview_data[scene_id] if multiview_data is not None else None
+        floor_height = scene_store.get_floor_height(scene_id) if use_height else None
+
+        points, colors, bboxes = None, None, None
+        for k in range(num_variants):
+            choices = sample_choices(scene["xyz"].shape[0], num_points)
+            point_cloud, pcl_color = gather_point_cloud(scene, choices, use_color, use_normal, multiview, floor_height)
+            variant_bboxes = instance_bboxes.copy()
+            if augment:
+                point_cloud, variant_bboxes[:, 0:6] = augment_point_cloud(point_cloud, variant_bboxes[:, 0:6])
+
+            if points is None:
+                prefix = os.path.join(path, scene_id)
+                points = np.lib.format.open_memmap(prefix + "_points.npy", mode="w+", dtype=np.float32, shape=(num_variants,) + point_cloud.shape)
+                colors = np.lib.format.open_memmap(prefix + "_color.npy", mode="w+", dtype=np.float32, shape=(num_variants,) + pcl_color.shape)
+                bboxes = np.lib.format.open_memmap(prefix + "_bbox.npy", mode="w+", dtype=instance_bboxes.dtype, shape=(num_variants,) + instance_bboxes.shape)
+            points[k] = point_cloud
+            colors[k] = pcl_color
+            bboxes[k] = variant_bboxes
+
+        for data in [points, colors, bboxes]:
+            data.flush()
+        del points, colors, bboxes
+
+    meta = {
+        "num_variants": num_variants,
+        "num_points": num_points,
+        "use_color": use_color,
+        "use_normal": use_normal,
+        "use_multiview": multiview_path is not None,
+        "use_height": use_height,
+        "augment": augment,
+        "scenes": list(scene_store.scene_list)
+    }
+    with open(os.path.join(path, BANK_META), "w") as f:
+        json.dump(meta, f, indent=4)
+
+
+class AugmentationBank():
+    """
+    Read-only, memory-mapped view of a bank written by write_bank().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, BANK_META)) as f:
+            self.meta = json.load(f)
+        self.num_variants = self.meta["num_variants"]
+        self.scenes = set(self.meta["scenes"])
+
+        self._data = {}
+
+    def __contains__(self, scene_id):
+        return scene_id in self.scenes
+
+    def check(self, scene_list, **flags):
+        """
+        Raise if the bank misses scenes of scene_list or was built with other settings than the dataset using it.
+        """
+        missing = [scene_id for scene_id in scene_list if scene_id not in self.scenes]
+        if len(missing) > 0:
+            raise ValueError("augmentation bank {} misses {} scenes, e.g. {}".format(self.path, len(missing), missing[0]))
+
+        for flag in BANK_FLAGS:
+            if flag in flags and flags[flag] != self.meta[flag]:
+                raise ValueError("augmentation bank {} was built with {}={}, but {} was requested".format(
+                    self.path, flag, self.meta[flag], flags[flag]))
+
+    def sample(self, scene_id, rng=np.random):
+        """
+        One random variant of the scene as (point cloud, colors, boxes), copies that may be modified.
+        """
+        if scene_id not in self._data:
+            prefix = os.path.join(self.path, scene_id)
+            self._data[scene_id] = [np.load(prefix + suffix, mmap_mode="r") for suffix in ["_points.npy", "_color.npy", "_bbox.npy"]]
+
+        k = rng.randint(self.num_variants)
+
+        return tuple(np.array(data[k]) for data in self._data[scene_id])
+
+    def __getstate__(self):
+        # reopen the memmaps instead of pickling their content
+        state = self.__dict__.copy()
+        state["_data"] = {}
+        return state
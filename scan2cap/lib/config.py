@@ -22,6 +22,9 @@ CONF.PATH.SCANNET_SCANS = os.path.join(CONF.PATH.SCANNET, "scans")
 CONF.PATH.SCANNET_META = os.path.join(CONF.PATH.SCANNET, "meta_data")
 CONF.PATH.SCANNET_DATA = os.path.join(CONF.PATH.SCANNET, "scannet_data")
 
+# cached derived data (annotation tables, ...)
+CONF.PATH.CACHE = os.path.join(CONF.PATH.DATA, "cache")
+
 # output
 CONF.PATH.OUTPUT = os.path.join(CONF.PATH.BASE, "outputs")
 
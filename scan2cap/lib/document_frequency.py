@@ -0,0 +1,128 @@
+"""
+Corpus document frequencies of the CIDEr n-grams, counted once over all ScanRefer descriptions.
+
+A document is one object, i.e. all descriptions of the same (scene, object), like an image
+with its reference captions in CIDEr. The n-grams are the int64 keys of utils.token_scorer.ngram_keys(),
+stored as a sorted key block and a count block in the layout of the multiview store:
+
+    magic (8 bytes) | header length (uint64) | json header | keys (int64) | counts (int32)
+
+A lookup is one searchsorted over the memory-mapped keys. Build with
+scripts/build_document_frequency.py and pass the file to SolverCaptioning as cider_document_frequency.
+"""
+
+import os
+import sys
+import json
+import struct
+import numpy as np
+
+sys.path.append(os.path.join(os.getcwd(), "lib")) # HACK add the lib folder
+from lib.config import CONF
+from lib.annotation_table import AnnotationTable
+from utils.tokens import compact_tokens
+from utils.token_scorer import ngram_keys
+
+MAGIC = b"S2CCDF01"
+ALIGNMENT = 64
+
+# stores opened in this process, by path
+_LOADED = {}
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_document_frequency(path, scanrefers, vocabulary, n=4, max_len=CONF.TRAIN.MAX_DES_LEN):
+    """
+    Count in how many objects every 1..n-gram of the descriptions occurs.
+
+    :param path: output file
+    :param scanrefers: list of ScanRefer splits, each a list of annotations
+    :param vocabulary: list of words, the one the captions are decoded with
+    :param max_len: descriptions are cut like the references of the dataset
+    """
+    keys = []
+    documents = []
+    num_documents = 0
+    for scanrefer in scanrefers:
+        annotations = AnnotationTable(scanrefer, vocabulary)
+        tokens, lengths = compact_tokens(annotations.padded(max_len)[0])
+        split_keys, valid = ngram_keys(tokens, lengths, n, len(vocabulary))
+        keys.append(split_keys[valid])
+        documents.append(np.broadcast_to(num_documents + annotations.group_idx[:, None].astype(np.int64), split_keys.shape)[valid])
+        num_documents += annotations.num_groups()
+
+    # every (n-gram, object) pair once, then the number of objects per n-gram
+    pairs = np.unique(np.stack([np.concatenate(keys), np.concatenate(documents)], axis=1), axis=0)
+    ngrams, counts = np.unique(pairs[:, 0], return_counts=True)
+
+    header = json.dumps({"n": n, "vocab_size": len(vocabulary), "num_documents": num_documents, "num_ngrams": int(ngrams.size)}).encode("utf-8")
+    keys_start = _align(len(MAGIC) + 8 + len(header))
+    counts_start = _align(keys_start + ngrams.size * 8)
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        f.seek(keys_start)
+        f.write(ngrams.astype("<i8").tobytes())
+        f.seek(counts_start)
+        f.write(counts.astype("<i4").tobytes())
+
+
+def load_document_frequency(path):
+    """
+    The store at path, opened once per process and shared by every later call.
+    """
+    if path not in _LOADED:
+        _LOADED[path] = DocumentFrequency(path)
+
+    return _LOADED[path]
+
+
+class DocumentFrequency():
+    """
+    Read-only, memory-mapped view of a store written by write_document_frequency().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._open()
+
+    def __call__(self, keys):
+        """
+        Number of objects whose descriptions contain each n-gram of keys, 0 for unseen n-grams.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if self._keys.size == 0:
+            return np.zeros(keys.shape, dtype=np.int64)
+        inds = np.minimum(np.searchsorted(self._keys, keys), self._keys.size - 1)
+
+        return np.where(self._keys[inds] == keys, self._counts[inds], 0).astype(np.int64)
+
+    def __getstate__(self):
+        # reopen the memmap instead of pickling its content
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._open()
+
+    def _open(self):
+        with open(self.path, "rb") as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError("{} is not a document frequency store".format(self.path))
+            header_len = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(header_len).decode("utf-8"))
+
+        self.n = header["n"]
+        self.vocab_size = header["vocab_size"]
+        self.num_documents = header["num_documents"]
+        num_ngrams = header["num_ngrams"]
+
+        keys_start = _align(len(MAGIC) + 8 + header_len)
+        counts_start = _align(keys_start + num_ngrams * 8)
+        self._keys = np.memmap(self.path, dtype="<i8", mode="r", offset=keys_start, shape=(num_ngrams,)) if num_ngrams > 0 else np.zeros(0, dtype=np.int64)
+        self._counts = np.memmap(self.path, dtype="<i4", mode="r", offset=counts_start, shape=(num_ngrams,)) if num_ngrams > 0 else np.zeros(0, dtype=np.int32)
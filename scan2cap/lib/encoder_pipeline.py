@@ -0,0 +1,121 @@
+"""
+Pipelined frozen encoders: a separate process runs PointNetExtractor and VoteNet on the incoming batches
+while the training process runs the decoder forward / backward on the previous ones.
+
+Unlike the feature cache (lib/feature_cache.py) every batch is encoded fresh, so augmentation is kept.
+Batches travel to the worker through a bounded queue of shared memory tensors, the encoder outputs come
+back as CUDA tensors shared between the processes.
+"""
+
+import os
+import sys
+import copy
+import traceback
+import torch
+import torch.multiprocessing as mp
+
+sys.path.append(os.path.join(os.getcwd(), "lib")) # HACK add the lib folder
+from models.scan2cap_model import run_encoders
+
+
+def _encoder_worker(pn_extractor, votenet_extractor, augmentation, in_queue, out_queue):
+    try:
+        pn_extractor = pn_extractor.cuda().eval()
+        if votenet_extractor is not None:
+            votenet_extractor = votenet_extractor.cuda().eval()
+
+        while True:
+            item = in_queue.get()
+            if item is None:
+                break
+
+            data_dict, augment = item
+            for key in data_dict:
+                # non-tensor entries such as lang_tokens stay on the host
+                if torch.is_tensor(data_dict[key]):
+                    data_dict[key] = data_dict[key].cuda()
+
+            with torch.no_grad():
+                if augment and augmentation is not None:
+                    data_dict = augmentation(data_dict)
+                data_dict = run_encoders(data_dict, pn_extractor, votenet_extractor)
+
+            out_queue.put(data_dict)
+    except Exception:
+        out_queue.put(traceback.format_exc())
+
+
+class EncoderPipeline():
+    """
+    Runs the frozen encoders of a Scan2CapModel in a worker process, see SolverCaptioning(pipeline=True).
+
+    At most depth batches are in flight, the training process only sees batches that already carry
+    the encoder outputs, so Scan2CapModel.forward() goes straight to the decoder.
+
+    :param model: Scan2CapModel with frozen (loaded) encoders
+    :param augmentation: BatchAugmentation applied in the worker before encoding, or None
+    :param depth: size of the bounded queues
+    """
+
+    def __init__(self, model, augmentation=None, depth=2):
+        encoders = [model.pn_extractor] + ([model.votenet_extractor] if model.use_votenet else [])
+        if any(p.requires_grad for encoder in encoders for p in encoder.parameters()):
+            raise ValueError("the encoder pipeline needs frozen encoders, load the pointnet and votenet checkpoints")
+
+        self.depth = depth
+        ctx = mp.get_context("spawn")
+        self._in_queue = ctx.Queue(depth)
+        self._out_queue = ctx.Queue(depth)
+        self._process = ctx.Process(
+            target=_encoder_worker,
+            args=(
+                copy.deepcopy(model.pn_extractor).cpu(),
+                copy.deepcopy(model.votenet_extractor).cpu() if model.use_votenet else None,
+                augmentation,
+                self._in_queue,
+                self._out_queue
+            ),
+            daemon=True
+        )
+        self._process.start()
+
+    def __call__(self, dataloader, augment=False):
+        """
+        Yield the batches of dataloader with the encoder outputs added, in order.
+        """
+        batches = iter(dataloader)
+        in_flight = 0
+        try:
+            # fill the pipeline
+            for data_dict in batches:
+                self._in_queue.put((data_dict, augment))
+                in_flight += 1
+                if in_flight == self.depth:
+                    break
+
+            while in_flight > 0:
+                data_dict = self._get()
+                in_flight -= 1
+                # keep the worker busy while the caller trains on this batch
+                for next_dict in batches:
+                    self._in_queue.put((next_dict, augment))
+                    in_flight += 1
+                    break
+
+                yield data_dict
+        finally:
+            # the caller stopped early, drop the batches still in flight
+            for _ in range(in_flight if self._process.is_alive() else 0):
+                self._get()
+
+    def _get(self):
+        item = self._out_queue.get()
+        if isinstance(item, str):
+            raise RuntimeError("encoder worker failed:\n" + item)
+
+        return item
+
+    def close(self):
+        if self._process.is_alive():
+            self._in_queue.put(None)
+            self._process.join()
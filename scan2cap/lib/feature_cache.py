@@ -0,0 +1,172 @@
+"""
+Persistent cache of the frozen encoder outputs, for decoder-only training.
+
+Layout of a cache folder:
+
+    meta.json              flags the cache was built with and the (scene_id, object_id) of every row
+    <key>.npy              (K, num_objects, ...) float16 outputs of PointNetExtractor / VoteNet
+
+K is the number of (augmented) variants per object. Build one with scripts/cache_backbone_features.py
+and train on it with CachedFeatureDataset, Scan2CapModel skips the encoders for batches that already
+carry their features.
+"""
+
+import os
+import sys
+import json
+import time
+import functools
+import torch
+import numpy as np
+from torch.utils.data import Dataset, DataLoader
+
+sys.path.append(os.path.join(os.getcwd(), "lib")) # HACK add the lib folder
+from lib.config import CONF
+from lib.annotation_table import AnnotationTable
+
+CACHE_META = "meta.json"
+CACHE_KEYS = ["ref_obj_features", "aggregated_vote_features", "aggregated_vote_xyz", "objectness_scores"]
+# the decoders select proposals around the (augmented) target box
+LABEL_KEYS = ["ref_center_label"]
+MAX_DIFF_ANNS = 5
+
+
+def _seed_worker(seed, variant, worker_id):
+    # the loader workers of torch 1.2 fork with the numpy state of the parent, every pass would draw the same augmentation
+    np.random.seed([seed, variant, worker_id])
+
+
+def write_feature_cache(path, model, dataset, num_variants, batch_size=16, num_workers=4, seed=0):
+    """
+    Run the encoders of model over every object of dataset num_variants times and store their outputs.
+
+    :param path: output folder
+    :param model: Scan2CapModel with frozen (loaded) encoders
+    :param dataset: Scan2CapDataset created with multi_ref=True, augmented if the variants should differ
+    :param seed: numpy seed of the loader workers, combined with the variant and the worker id
+    """
+    if not dataset.multi_ref:
+        raise ValueError("the feature cache stores one row per object, create the dataset with multi_ref=True")
+
+    os.makedirs(path, exist_ok=True)
+    group_idx = torch.from_numpy(dataset.annotations.group_idx.astype(np.int64))
+    keys = CACHE_KEYS if model.use_votenet else CACHE_KEYS[:1]
+
+    model.eval()
+    store = {}
+    with torch.no_grad():
+        for k in range(num_variants):
+            np.random.seed([seed, k])
+            dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                worker_init_fn=functools.partial(_seed_worker, seed, k))
+            for data_dict in dataloader:
+                for key in data_dict:
+                    data_dict[key] = data_dict[key].cuda()
+
+                data_dict = model.pn_extractor(data_dict)
+                if model.use_votenet:
+                    data_dict = model.votenet_extractor(data_dict)
+
+                rows = group_idx[data_dict["scan_idx"].cpu()].numpy()
+                for key in keys + LABEL_KEYS:
+                    value = data_dict[key].cpu().numpy()
+                    if key not in store:
+                        store[key] = np.lib.format.open_memmap(os.path.join(path, key + ".npy"), mode="w+",
+                            dtype=np.float16 if key in CACHE_KEYS else np.float32, shape=(num_variants, len(dataset)) + value.shape[1:])
+                    store[key][k, rows] = value
+
+    for data in store.values():
+        data.flush()
+
+    annotations = dataset.annotations
+    first = annotations.group_members[annotations.group_offsets[:-1]]
+    meta = {
+        "num_variants": num_variants,
+        "keys": keys,
+        "use_color": dataset.use_color,
+        "use_normal": dataset.use_normal,
+        "use_multiview": dataset.use_multiview,
+        "use_height": dataset.use_height,
+        "augment": dataset.augment or dataset.bank is not None,
+        "objects": ["{}/{}".format(annotations.scene_id(i), annotations.object_ids[i]) for i in first]
+    }
+    with open(os.path.join(path, CACHE_META), "w") as f:
+        json.dump(meta, f, indent=4)
+
+
+class CachedFeatureDataset(Dataset):
+    """
+    Scan2CapDataset for decoder-only training: the language fields of every description together with
+    the cached encoder outputs of a random variant of its object, no point clouds involved.
+    """
+
+    def __init__(self, scanrefer, vocabulary, cache_path, multi_ref=False):
+        self.index2vocab = vocabulary
+        self.cache_path = cache_path
+        self.multi_ref = multi_ref
+
+        self._load_data(scanrefer)
+        self._data = None
+
+    def __len__(self):
+        return len(self.sample_indices)
+
+    def __getitem__(self, idx):
+        start = time.time()
+        idx = self.sample_indices[idx]
+        if self._data is None:
+            self._data = {key: np.load(os.path.join(self.cache_path, key + ".npy"), mmap_mode="r") for key in self.keys}
+
+        other_ann_ids = self.annotations.group(idx)[:MAX_DIFF_ANNS]
+        other_lang_lens = np.zeros((MAX_DIFF_ANNS), dtype=np.int64)
+        other_lang_lens[:len(other_ann_ids)] = self.lang_lens[other_ann_ids]
+        other_lang_indices = np.zeros((MAX_DIFF_ANNS, CONF.TRAIN.MAX_DES_LEN), dtype=np.int64) - 1
+        other_lang_indices[:len(other_ann_ids)] = self.lang_indices[other_ann_ids]
+
+        row = self.rows[self.annotations.group_idx[idx]]
+        k = np.random.randint(self.num_variants)
+
+        data_dict = {}
+        data_dict["scan_idx"] = np.array(idx).astype(np.int64)
+        data_dict["lang_indices"] = self.lang_indices[idx]
+        data_dict["lang_len"] = np.array(self.lang_lens[idx]).astype(np.int64)
+        data_dict["other_lang_indices"] = other_lang_indices
+        data_dict["other_lang_lens"] = other_lang_lens
+        for key in self.keys:
+            data_dict[key] = self._data[key][k, row].astype(np.float32)
+        data_dict["object_id"] = np.array(self.annotations.object_ids[idx]).astype(np.int64)
+        data_dict["ann_id"] = np.array(self.annotations.ann_ids[idx]).astype(np.int64)
+        data_dict["load_time"] = time.time() - start
+
+        return data_dict
+
+    def _load_data(self, scanrefer):
+        print("loading data...")
+        self.annotations = AnnotationTable(scanrefer, self.index2vocab)
+        self.lang_indices, self.lang_lens = self.annotations.padded(CONF.TRAIN.MAX_DES_LEN)
+        self.scene_list = self.annotations.scene_list
+
+        if self.multi_ref:
+            self.sample_indices = self.annotations.group_members[self.annotations.group_offsets[:-1]]
+        else:
+            self.sample_indices = np.arange(len(self.annotations))
+
+        with open(os.path.join(self.cache_path, CACHE_META)) as f:
+            self.meta = json.load(f)
+        self.num_variants = self.meta["num_variants"]
+        self.keys = self.meta["keys"] + LABEL_KEYS
+
+        # cache row of every object group of the table
+        object2row = {name: i for i, name in enumerate(self.meta["objects"])}
+        first = self.annotations.group_members[self.annotations.group_offsets[:-1]]
+        objects = ["{}/{}".format(self.annotations.scene_id(i), self.annotations.object_ids[i]) for i in first]
+        missing = [name for name in objects if name not in object2row]
+        if len(missing) > 0:
+            raise ValueError("feature cache {} misses {} objects, e.g. {}".format(self.cache_path, len(missing), missing[0]))
+        self.rows = np.array([object2row[name] for name in objects], dtype=np.int64)
+
+    def __getstate__(self):
+        # reopen the memmaps instead of pickling their content
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
@@ -15,10 +15,10 @@ sys.path.append(os.path.join(os.getcwd(), "lib")) # HACK add the lib folder
 sys.path.append(os.path.join(os.getcwd(), "utils")) # HACK add the utils folder
 sys.path.append(os.path.join(os.getcwd(), "utils/pycocoevalcap"))
 
-from utils.pycocoevalcap.bleu.bleu import Bleu
 from utils.meteor import *
-from utils.pycocoevalcap.rouge.rouge import Rouge
-from utils.pycocoevalcap.cider.cider import Cider
+from utils.tokens import detokenize, count_tokens, compact_tokens
+from utils.token_scorer import TokenScorer
+from lib.document_frequency import load_document_frequency
 
 def pointnet_pretrain_loss(data_dict):
     target = data_dict["ref_nyu40_label"]
@@ -34,83 +34,100 @@ def pointnet_pretrain_loss(data_dict):
 
     return loss, data_dict
 
-def caption_loss(data_dict, vocabulary):
+# word indices counted as sentence ends by mean_sentence_length
+SENTENCE_END_TOKENS = [15, 17]
 
+def caption_loss(data_dict, vocabulary):
     targets = data_dict["lang_indices"]
-    
-    scores = data_dict["caption_predictions"]
-      
-    loss = F.cross_entropy(scores, targets, ignore_index=-1)
-    data_dict["loss"] = loss
-
-    references = {}
-    hypotheses = {}
-
-    hypo = torch.argmax(scores, dim=1)
 
-    for i in range(targets.size(0)):
-        #stringify
-        target_strings = [" ".join([vocabulary[index] for index in targets[i] if index > 0])]
-
-        num_oth_ref = data_dict["other_lang_indices"].size(1)
-        oth_ref = [
-            ' '.join([vocabulary[index] for index in data_dict["other_lang_indices"][i,t,:] if index > 0])
-            for t in range(num_oth_ref)]
-        references["{}".format(i)] = oth_ref
+    # at inference the decoders only return scores when asked for (eval_scores) and never for beam search,
+    # without them there is no loss (None) rather than a made up one
+    if "caption_predictions" in data_dict:
+        loss = F.cross_entropy(data_dict["caption_predictions"], targets, ignore_index=-1)
+    else:
+        loss = None
+    data_dict["loss"] = loss
 
-        hypo_strings = [vocabulary[index] for index in hypo[i] if index > 0]
-        hypotheses["{}".format(i)] = [' '.join(hypo_strings)]
+    return loss, data_dict
 
-    #print("Ref:", references["0"][0])
-    #print("Hyp:", hypotheses["0"][0])
 
-    bleu4, _ = Bleu(n=4).compute_score(references, hypotheses)
+def caption_metric_inputs(data_dict):
+    """
+    Host copies of everything caption_metrics() needs, so the metrics can be computed
+    in another process while the batch moves on.
+    """
+    if "caption_indices" in data_dict:
+        hypo = data_dict["caption_indices"]
+    else:
+        hypo = torch.argmax(data_dict["caption_predictions"], dim=1)
+
+    inputs = {
+        "other_lang_indices": data_dict["other_lang_indices"].detach().cpu().numpy(),
+        "hypo": hypo.detach().cpu().numpy(),
+        "lang_indices": data_dict["lang_indices"].detach().cpu().numpy(),
+        "lang_len": data_dict["lang_len"].detach().cpu().numpy(),
+        "decoded": "caption_indices" in data_dict,
+    }
+    if "alphas" in data_dict:
+        inputs["alphas"] = data_dict["alphas"].detach().cpu().numpy()
+
+    return inputs
+
+
+def caption_metrics(inputs, vocabulary, document_frequency=None):
+    """
+    BLEU-4, METEOR, ROUGE-L and CIDEr of the hypotheses against the other descriptions of each object,
+    plus attention and caption length statistics.
+
+    :param inputs: from caption_metric_inputs()
+    :param document_frequency: path of corpus CIDEr document frequencies (see scripts/build_document_frequency.py),
+                               None counts them over the references of the batch
+    :return: dict of floats
+    """
+    #stringify
+    ref_sentences = detokenize(inputs["other_lang_indices"], vocabulary)
+    hypo_sentences = detokenize(inputs["hypo"], vocabulary)
+    references = {"{}".format(i): list(refs) for i, refs in enumerate(ref_sentences)}
+    hypotheses = {"{}".format(i): [hypo] for i, hypo in enumerate(hypo_sentences)}
+
+    # BLEU, CIDEr and ROUGE-L are computed on the word indices, same scores as the string scorers
+    hypo_tokens, hypo_lengths = compact_tokens(inputs["hypo"])
+    ref_tokens, ref_lengths = compact_tokens(inputs["other_lang_indices"])
+    scorer = TokenScorer(hypo_tokens, hypo_lengths, ref_tokens, ref_lengths, len(vocabulary), n=4)
+    bleu4, _ = scorer.bleu()
+    cider, _ = scorer.cider(document_frequency=load_document_frequency(document_frequency) if document_frequency is not None else None)
+    rouge, _ = scorer.rouge()
     meteor = compute_meteor(references, hypotheses)
-    rouge, _ = Rouge().compute_score(references, hypotheses)
-    cider, _ = Cider().compute_score(references, hypotheses)
-
 
-    #print(bleu4, meteor, rouge, cider)
-
-    #meteor = 0
-    data_dict["bleu4"] = bleu4[3]
-    data_dict["rouge"]= rouge
-    data_dict["meteor"] = meteor
-    data_dict["cider"] = cider
-    if "alphas" in data_dict:
-        att = data_dict["alphas"].detach().cpu().numpy()
-        att_max = np.max(att)
-        att_var = np.var(att, axis=-1)
-        att_var = np.mean(att_var)
+    metrics = {
+        "bleu4": bleu4[3],
+        "rouge": rouge,
+        "meteor": meteor,
+        "cider": cider,
+    }
+    if "alphas" in inputs:
+        att = inputs["alphas"]
+        metrics["attention_max"] = np.max(att)
+        metrics["attention_var"] = np.mean(np.var(att, axis=-1))
     else:
-        att_max = 0
-        att_var = 0
-    data_dict["attention_max"] = att_max
-    data_dict["attention_var"] = att_var
-
-    caption_length_gen = 0
-    caption_length_gt = 0
-    num_sent_val = []
-    num_sent_train = []
-
-    #calculate dataset metrics 
-    if "caption_indices" in data_dict:
-        for ci in data_dict["caption_indices"].detach().cpu().numpy():
-            num_sent_val.append(sum([(x==17 or x==15) for x in ci]))
-        data_dict["mean_sentence_length"] = np.mean(np.asarray(num_sent_val))
-        batch_caption_lengths = (data_dict["caption_indices"] > 0).to(dtype=torch.int32).sum(dim=1)    
-        data_dict["batch_caption_lenghts"] = batch_caption_lengths
-        caption_length_gen += batch_caption_lengths.sum()
-        caption_length_gt += (data_dict["lang_len"] - 1).sum()
-        data_dict["caption_ratio"] = (caption_length_gen / caption_length_gt).detach().cpu().numpy()
+        metrics["attention_max"] = 0
+        metrics["attention_var"] = 0
+
+    #calculate dataset metrics
+    if inputs["decoded"]:
+        metrics["mean_sentence_length"] = np.mean(count_tokens(inputs["hypo"], SENTENCE_END_TOKENS))
+        caption_length_gen = (inputs["hypo"] > 0).sum()
+        caption_length_gt = (inputs["lang_len"] - 1).sum()
+        metrics["caption_ratio"] = caption_length_gen / caption_length_gt
     else:
-        for li in data_dict["lang_indices"].detach().cpu().numpy():
-            num_sent_train.append(sum([(x==17 or x==15) for x in li]))
-        data_dict["mean_sentence_length"] = np.mean(np.asarray(num_sent_train))
-        data_dict["caption_ratio"] = np.array([1])
-    return loss, data_dict
+        metrics["mean_sentence_length"] = np.mean(count_tokens(inputs["lang_indices"], SENTENCE_END_TOKENS))
+        metrics["caption_ratio"] = 1
+
+    return metrics
 
 
 def attention_regularization(data_dict, alpha_c=1.):
+    if data_dict["loss"] is None:
+        return data_dict
     data_dict["loss"] += alpha_c * ((1. - data_dict["alphas"].sum(dim=1)) ** 2).mean()
     return data_dict
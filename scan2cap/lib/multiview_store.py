@@ -0,0 +1,108 @@
+"""
+Memory-mapped store for the per-vertex multiview features of enet_feats.hdf5.
+
+All scenes are packed into one file, in the layout of the scene archive (data/scannet/scannet_archive.py):
+
+    magic (8 bytes) | header length (uint64) | json header | feature block
+
+The feature block holds the (num_vertices, 128) rows of every scene back to back, so a sample only
+reads the pages of its sampled rows instead of the whole scene. Rows can be stored as float16,
+which halves the reads again. Convert with scripts/convert_multiview.py and pass the file to
+Scan2CapDataset as multiview_store.
+"""
+
+import json
+import struct
+import h5py
+import numpy as np
+
+MAGIC = b"S2CMVIE1"
+ALIGNMENT = 64
+# rows copied from the hdf5 file at once while converting
+CHUNK_ROWS = 1 << 16
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_multiview_store(path, scene_list, multiview_path, quantize=False):
+    """
+    Copy the multiview features of scene_list from an hdf5 file into one memory-mappable store.
+
+    :param path: output file
+    :param scene_list: scenes to convert, in order
+    :param multiview_path: enet_feats.hdf5
+    :param quantize: store the features as float16
+    """
+    dtype = "float16" if quantize else "float32"
+    with h5py.File(multiview_path, "r", libver="latest") as multiview_data:
+        scenes = {}
+        rows = 0
+        for scene_id in scene_list:
+            count = multiview_data[scene_id].shape[0]
+            scenes[scene_id] = [rows, count]
+            rows += count
+        width = multiview_data[scene_list[0]].shape[1]
+
+        header = json.dumps({"dtype": dtype, "width": width, "scenes": scenes}).encode("utf-8")
+        data_start = _align(len(MAGIC) + 8 + len(header))
+        with open(path, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            f.truncate(data_start + rows * width * np.dtype(dtype).itemsize)
+
+        block = np.memmap(path, dtype=dtype, mode="r+", offset=data_start, shape=(rows, width))
+        for scene_id in scene_list:
+            start, count = scenes[scene_id]
+            data = multiview_data[scene_id]
+            for chunk in range(0, count, CHUNK_ROWS):
+                end = min(chunk + CHUNK_ROWS, count)
+                block[start + chunk:start + end] = data[chunk:end]
+        block.flush()
+        del block
+
+
+class MultiviewStore():
+    """
+    Read-only, memory-mapped view of a store written by write_multiview_store().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._open()
+
+    def __contains__(self, scene_id):
+        return scene_id in self.scenes
+
+    def __getitem__(self, scene_id):
+        """
+        Multiview features of one scene, as a read-only memmap in the stored dtype.
+        """
+        start, count = self.scenes[scene_id]
+
+        return self._block[start:start + count]
+
+    def __getstate__(self):
+        # reopen the memmap instead of pickling its content
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._open()
+
+    def _open(self):
+        with open(self.path, "rb") as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError("{} is not a multiview store".format(self.path))
+            header_len = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(header_len).decode("utf-8"))
+
+        data_start = _align(len(MAGIC) + 8 + header_len)
+        self.scenes = header["scenes"]
+        self.quantized = header["dtype"] == "float16"
+
+        rows = sum(count for _, count in self.scenes.values())
+        self._block = np.memmap(self.path, dtype=header["dtype"], mode="r", offset=data_start, shape=(rows, header["width"]))
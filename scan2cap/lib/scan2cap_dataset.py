@@ -11,18 +11,20 @@ import json
 import pickle
 import numpy as np
 import multiprocessing as mp
-from collections import defaultdict
 from torch.utils.data import Dataset
 
 sys.path.append(os.path.join(os.getcwd(), "lib")) # HACK add the lib folder
 from lib.config import CONF
-from utils.pc_utils import random_sampling, rotx, roty, rotz
-from data.scannet.model_util_scannet import rotate_aligned_boxes, ScannetDatasetConfig, rotate_aligned_boxes_along_axis
+from lib.scene_store import SceneStore, sample_choices, gather_point_cloud
+from lib.augmentation import augment_point_cloud
+from lib.augmentation_bank import AugmentationBank
+from lib.multiview_store import MultiviewStore
+from lib.annotation_table import AnnotationTable
+from data.scannet.model_util_scannet import ScannetDatasetConfig
 
 # data setting
 DC = ScannetDatasetConfig()
 MAX_NUM_OBJ = 128
-MEAN_COLOR_RGB = np.array([109.8, 97.2, 83.8])
 
 # data path
 SCANNET_V2_TSV = os.path.join(CONF.PATH.SCANNET_META, "scannetv2-labels.combined.tsv")
@@ -41,10 +43,15 @@ class Scan2CapDataset(Dataset):
                  use_normal=False,
                  use_multiview=False,
                  augment=False,
+                 scene_archive=None,
+                 lazy_scenes=False,
+                 scene_cache_bytes=4 * 1024 ** 3,
+                 multiview_store=None,
+                 augment_bank=None,
+                 multi_ref=False,
                  lang_tokens=False,
                  class_weights=None):
 
-        self.scanrefer = scanrefer
         self.scanrefer_all_scene = scanrefer_all_scene # all scene_ids in scanrefer
         self.index2vocab = vocabulary
         self.split = split
@@ -54,120 +61,58 @@ class Scan2CapDataset(Dataset):
         self.use_normal = use_normal        
         self.use_multiview = use_multiview
         self.augment = augment
+        self.scene_archive = scene_archive
+        self.lazy_scenes = lazy_scenes
+        self.scene_cache_bytes = scene_cache_bytes
+        self.multiview_store = multiview_store
+        self.augment_bank = augment_bank
+        self.multi_ref = multi_ref
         self.lang_tokens = lang_tokens
         self.class_weights = class_weights
 
-        # load data
-        self._load_data()
+        # load data, the annotations are kept as a table only
+        self._load_data(scanrefer)
         self.multiview_data = {}
+        self._last_sample = None
 
     def __len__(self):
-        return len(self.scanrefer)
+        return len(self.sample_indices)
 
-    def __getitem__(self, idx):
+    def __getitem__(self, index):
         start = time.time()
-        scene_id = self.scanrefer[idx]["scene_id"]
-        object_id = int(self.scanrefer[idx]["object_id"])
-        object_name = " ".join(self.scanrefer[idx]["object_name"].split("_"))
-        ann_id = self.scanrefer[idx]["ann_id"]
+        idx, prefetch_idx, seed = self._unpack_index(index)
+        idx = self.sample_indices[idx]
+        scene_id = self.annotations.scene_id(idx)
+        if prefetch_idx is not None:
+            self.scene_data.prefetch([self.annotations.scene_id(self.sample_indices[prefetch_idx])])
+        object_id = int(self.annotations.object_ids[idx])
+        object_name = " ".join(self.annotations.object_name(idx).split("_"))
+        ann_id = self.annotations.ann_ids[idx]
         
         # get language features
-        lang_tokens = self.scanrefer[idx]["token"]
-        lang_len = len(lang_tokens) + 1
-        lang_len = lang_len if lang_len <= CONF.TRAIN.MAX_DES_LEN else CONF.TRAIN.MAX_DES_LEN
-
-        lang_indices = np.zeros((CONF.TRAIN.MAX_DES_LEN)) - 1
-        lang_indices[:lang_len-1] = np.array([self.vocab2index[t] for t in lang_tokens[:lang_len-1]])
-        lang_indices[lang_len-1] = self.vocab2index["<end>"]
-
-        other_ann_ids = self.different_annotations[(scene_id, object_id)]
-        other_lang_lens = np.zeros((MAX_DIFF_ANNS), dtype=np.int)
-        other_lang_lens[:len(other_ann_ids)] = np.array([min(len(self.scanrefer[o_id]["token"]) + 1, CONF.TRAIN.MAX_DES_LEN) for o_id in other_ann_ids])
-        other_lang_indices = np.zeros((MAX_DIFF_ANNS, CONF.TRAIN.MAX_DES_LEN)) - 1
-        for i, o_id in enumerate(other_ann_ids):
-            o_tokens = self.scanrefer[o_id]["token"]
-            o_len = other_lang_lens[i]
-            other_lang_indices[i, :o_len-1] = np.array([self.vocab2index[t] for t in o_tokens[:o_len-1]])
-            other_lang_indices[i, o_len-1] = self.vocab2index["<end>"]
-
-        # get pc
-        mesh_vertices = self.scene_data[scene_id]["mesh_vertices"]
-        instance_bboxes = self.scene_data[scene_id]["instance_bboxes"]
-
-        if not self.use_color:
-            point_cloud = mesh_vertices[:,0:3] # do not use color for now
-            pcl_color = mesh_vertices[:,3:6]
-        else:
-            point_cloud = mesh_vertices[:,0:6] 
-            point_cloud[:,3:] = (point_cloud[:,3:]-MEAN_COLOR_RGB)/256.0
-            pcl_color = point_cloud[:,3:]
-        
-        if self.use_normal:
-            normals = mesh_vertices[:,6:9]
-            point_cloud = np.concatenate([point_cloud, normals],1)
-
-        if self.use_multiview:
-            # load multiview database
-            pid = mp.current_process().pid
-            if pid not in self.multiview_data:
-                self.multiview_data[pid] = h5py.File(MULTIVIEW_DATA, "r", libver="latest")
-
-            multiview = self.multiview_data[pid][scene_id]
-            point_cloud = np.concatenate([point_cloud, multiview],1)
-
-        if self.use_height:
-            floor_height = np.percentile(point_cloud[:,2],0.99)
-            height = point_cloud[:,2] - floor_height
-            point_cloud = np.concatenate([point_cloud, np.expand_dims(height, 1)],1) 
-            
-        # ------------------------------- LABELS ------------------------------
-        bbox = instance_bboxes[instance_bboxes[:, 7] == object_id, :]
-        class_label = bbox[0, 6]
+        lang_indices = self.lang_indices[idx]
+        lang_len = self.lang_lens[idx]
 
-        point_cloud, choices = random_sampling(point_cloud, self.num_points, return_choices=True)        
-        pcl_color = pcl_color[choices]
+        other_ann_ids = self.annotations.group(idx)[:MAX_DIFF_ANNS]
+        other_lang_lens = np.zeros((MAX_DIFF_ANNS), dtype=np.int64)
+        other_lang_lens[:len(other_ann_ids)] = self.lang_lens[other_ann_ids]
+        other_lang_indices = np.zeros((MAX_DIFF_ANNS, CONF.TRAIN.MAX_DES_LEN), dtype=np.int64) - 1
+        other_lang_indices[:len(other_ann_ids)] = self.lang_indices[other_ann_ids]
 
-        target_bboxes = bbox[:, 0:6]
+        # get pc, sampled and augmented together with all boxes of the scene
+        point_cloud, pcl_color, instance_bboxes = self._get_scene_sample(scene_id, seed)
 
-        # ------------------------------- DATA AUGMENTATION ------------------------------
-        if self.augment:
-            if np.random.random() > 0.5:
-                # Flipping along the YZ plane
-                point_cloud[:,0] = -1 * point_cloud[:,0]
-                target_bboxes[:,0] = -1 * target_bboxes[:,0]                
-                
-            if np.random.random() > 0.5:
-                # Flipping along the XZ plane
-                point_cloud[:,1] = -1 * point_cloud[:,1]
-                target_bboxes[:,1] = -1 * target_bboxes[:,1]                                
-
-            # Rotation along X-axis
-            rot_angle = (np.random.random()*np.pi/18) - np.pi/36 # -5 ~ +5 degree
-            rot_mat = rotx(rot_angle)
-            point_cloud[:,0:3] = np.dot(point_cloud[:,0:3], np.transpose(rot_mat))
-            target_bboxes = rotate_aligned_boxes_along_axis(target_bboxes, rot_mat, "x")
-
-            # Rotation along Y-axis
-            rot_angle = (np.random.random()*np.pi/18) - np.pi/36 # -5 ~ +5 degree
-            rot_mat = roty(rot_angle)
-            point_cloud[:,0:3] = np.dot(point_cloud[:,0:3], np.transpose(rot_mat))
-            target_bboxes = rotate_aligned_boxes_along_axis(target_bboxes, rot_mat, "y")
-
-            # Rotation along up-axis/Z-axis
-            rot_angle = (np.random.random()*np.pi/18) - np.pi/36 # -5 ~ +5 degree
-            rot_mat = rotz(rot_angle)
-            point_cloud[:,0:3] = np.dot(point_cloud[:,0:3], np.transpose(rot_mat))
-            target_bboxes = rotate_aligned_boxes_along_axis(target_bboxes, rot_mat, "z")
-
-            # Translation
-            point_cloud, target_bboxes = self._translate(point_cloud, target_bboxes)
+        # ------------------------------- LABELS ------------------------------
+        bbox = instance_bboxes[[self.scene_data.get_object_row(scene_id, object_id)]]
+        class_label = bbox[0, 6]
+        target_bboxes = bbox[:, 0:6]
 
         data_dict = {}
         data_dict["scan_idx"] = np.array(idx).astype(np.int64)
         data_dict["point_clouds"] = point_cloud.astype(np.float32) # point cloud data including features
         data_dict["lang_indices"] = lang_indices.astype(np.int64)
         if self.lang_tokens:
-            data_dict["lang_tokens"] = lang_tokens
+            data_dict["lang_tokens"] = self.annotations.raw_tokens(idx)
         data_dict["lang_len"] = np.array(lang_len).astype(np.int64) # length of each description
         data_dict["other_lang_indices"] = other_lang_indices.astype(np.int64)
         data_dict["other_lang_lens"] = other_lang_lens.astype(np.int64)
@@ -180,11 +125,67 @@ class Scan2CapDataset(Dataset):
         data_dict["ann_id"] = np.array(int(ann_id)).astype(np.int64)
         data_dict["object_cat"] = np.array(self.raw2label[object_name]).astype(np.int64)
         data_dict["class_weights"] = self.class_weights
-        data_dict["pcl_color"] = pcl_color
+        if seed is not None:
+            data_dict["scene_seed"] = np.array(seed).astype(np.int64) # samples with the same seed share their point cloud
         data_dict["load_time"] = time.time() - start
 
         return data_dict
     
+    def get_scene_ids(self):
+        """
+        Scene id of every sample, see SceneBatchSampler.
+        """
+        return [self.annotations.scene_id(i) for i in self.sample_indices]
+
+    def _get_scene_sample(self, scene_id, seed=None):
+        """
+        Sampled point cloud of a scene, its colors and all boxes of the scene, augmented alike.
+        Draws with the same seed are identical, so the last one of this worker is reused.
+        """
+        if seed is not None and self._last_sample is not None and self._last_sample[0] == (scene_id, seed):
+            return self._last_sample[1]
+
+        rng = np.random.RandomState(seed) if seed is not None else np.random
+        if self.bank is not None:
+            # pre-sampled and pre-augmented variant of the scene
+            sample = self.bank.sample(scene_id, rng)
+        else:
+            # sample first, then gather only the sampled rows of every source
+            scene = self.scene_data[scene_id]
+            choices = sample_choices(scene["xyz"].shape[0], self.num_points, rng)
+            multiview = self._get_multiview(scene_id) if self.use_multiview else None
+            floor_height = self.scene_data.get_floor_height(scene_id) if self.use_height else None
+            point_cloud, pcl_color = gather_point_cloud(scene, choices, self.use_color, self.use_normal, multiview, floor_height)
+
+            instance_bboxes = np.array(scene["instance_bboxes"])
+            if self.augment:
+                point_cloud, instance_bboxes[:, 0:6] = augment_point_cloud(point_cloud, instance_bboxes[:, 0:6], rng)
+            sample = (point_cloud, pcl_color, instance_bboxes)
+
+        if seed is not None:
+            self._last_sample = ((scene_id, seed), sample)
+
+        return sample
+
+    def _get_multiview(self, scene_id):
+        if self.multiview_features is not None:
+            # memory-mapped, only the sampled rows are read
+            return self.multiview_features[scene_id]
+
+        # h5py handles do not survive a fork, open one per worker
+        pid = mp.current_process().pid
+        if pid not in self.multiview_data:
+            self.multiview_data[pid] = h5py.File(MULTIVIEW_DATA, "r", libver="latest")
+
+        return self.multiview_data[pid][scene_id]
+
+    def _unpack_index(self, index):
+        # ScenePrefetchSampler passes (idx, prefetch_idx) pairs, SceneBatchSampler (idx, prefetch_idx, seed)
+        if isinstance(index, tuple):
+            return tuple(index) + (None,) * (3 - len(index))
+
+        return index, None, None
+
     def _get_raw2label(self):
         # mapping
         scannet_labels = DC.type2class.keys()
@@ -205,26 +206,36 @@ class Scan2CapDataset(Dataset):
 
         return raw2label
 
-    def _load_data(self):
+    def _load_data(self, scanrefer):
         print("loading data...")
-        # add scannet data
-        self.scene_list = sorted(list(set([data["scene_id"] for data in self.scanrefer])))
+        # columnar, pre-tokenized annotations
+        self.annotations = AnnotationTable(scanrefer, self.index2vocab)
+        self.lang_indices, self.lang_lens = self.annotations.padded(CONF.TRAIN.MAX_DES_LEN)
+        self.scene_list = self.annotations.scene_list
+
+        # one sample per annotation, or per object with all of its descriptions in other_lang_indices
+        if self.multi_ref:
+            self.sample_indices = self.annotations.group_members[self.annotations.group_offsets[:-1]]
+        else:
+            self.sample_indices = np.arange(len(self.annotations))
 
-        self.different_annotations = defaultdict(lambda: [])
-        for i, data in enumerate(self.scanrefer):
-            self.different_annotations[(data["scene_id"], int(data["object_id"]))] += [i]
+        # load scene data, memory-mapped or on demand in lazy mode
+        columns = ["xyz", "rgb"] + (["color"] if self.use_color else []) + (["normal"] if self.use_normal else [])
+        self.scene_data = SceneStore(self.scene_list, archive_path=self.scene_archive, columns=columns, lazy=self.lazy_scenes, cache_bytes=self.scene_cache_bytes)
 
-        # load scene data
-        self.scene_data = {}
-        for scene_id in self.scene_list:
-            self.scene_data[scene_id] = {}
-            self.scene_data[scene_id]["mesh_vertices"] = np.load(os.path.join(CONF.PATH.SCANNET_DATA, scene_id)+"_vert.npy")
-            self.scene_data[scene_id]["instance_bboxes"] = np.load(os.path.join(CONF.PATH.SCANNET_DATA, scene_id)+"_bbox.npy")
+        # multiview features converted with scripts/convert_multiview.py
+        self.multiview_features = None
+        if self.use_multiview and self.multiview_store is not None:
+            self.multiview_features = MultiviewStore(self.multiview_store)
 
-        self.vocab2index = defaultdict(lambda : 0, {v: i for i, v in enumerate(self.index2vocab)})
+        # pre-sampled and pre-augmented scene variants
+        self.bank = None
+        if self.augment_bank is not None:
+            self.bank = AugmentationBank(self.augment_bank)
+            self.bank.check(self.scene_list, num_points=self.num_points, use_color=self.use_color, use_normal=self.use_normal,
+                use_multiview=self.use_multiview, use_height=self.use_height)
 
         if self.class_weights is not None:
-            l = len(self.scanrefer)
             self.class_weights = np.array([1 / self.class_weights[str(i)] if str(i) in self.class_weights else 1 for i in range(1, 41, 1)], dtype=np.float32)
         else:
             self.class_weights = np.array([1 for i in range(40)], dtype=np.float32)
@@ -242,20 +253,3 @@ class Scan2CapDataset(Dataset):
         # store
         self.raw2nyuid = raw2nyuid
         self.raw2label = self._get_raw2label()
-
-    def _translate(self, point_set, bbox):
-        # unpack
-        coords = point_set[:, :3]
-
-        # translation factors
-        x_factor = np.random.choice(np.arange(-0.5, 0.501, 0.001), size=1)[0]
-        y_factor = np.random.choice(np.arange(-0.5, 0.501, 0.001), size=1)[0]
-        z_factor = np.random.choice(np.arange(-0.5, 0.501, 0.001), size=1)[0]
-        factor = [x_factor, y_factor, z_factor]
-        
-        # dump
-        coords += factor
-        point_set[:, :3] = coords
-        bbox[:, :3] += factor
-
-        return point_set, bbox
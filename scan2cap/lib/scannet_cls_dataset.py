@@ -15,8 +15,10 @@ from torch.utils.data import Dataset
 
 sys.path.append(os.path.join(os.getcwd(), "lib"))  # HACK add the lib folder
 from lib.config import CONF
-from utils.pc_utils import random_sampling, rotx, roty, rotz
-from data.scannet.model_util_scannet import rotate_aligned_boxes, ScannetDatasetConfig, rotate_aligned_boxes_along_axis
+from lib.scene_store import SceneStore, sample_choices, gather_point_cloud
+from lib.augmentation import augment_point_cloud
+from lib.augmentation_bank import AugmentationBank
+from data.scannet.model_util_scannet import rotate_aligned_boxes, ScannetDatasetConfig
 
 # data setting
 DC = ScannetDatasetConfig()
@@ -39,7 +41,11 @@ class ScannetPretrainDataset(Dataset):
                  use_color=False,
                  use_normal=False,
                  use_multiview=False,
-                 augment=False):
+                 augment=False,
+                 scene_archive=None,
+                 lazy_scenes=False,
+                 scene_cache_bytes=4 * 1024 ** 3,
+                 augment_bank=None):
 
         self.scanrefer = scanrefer
         self.scanrefer_all_scene = scanrefer_all_scene  # all scene_ids in scanrefer
@@ -50,91 +56,35 @@ class ScannetPretrainDataset(Dataset):
         self.use_normal = use_normal
         self.use_multiview = use_multiview
         self.augment = augment
+        self.scene_archive = scene_archive
+        self.lazy_scenes = lazy_scenes
+        self.scene_cache_bytes = scene_cache_bytes
+        self.augment_bank = augment_bank
 
         # load data
         self._load_data()
         self.multiview_data = {}
+        self._last_sample = None
 
     def __len__(self):
         return len(self.samples)
 
-    def __getitem__(self, idx):
+    def __getitem__(self, index):
         start = time.time()
+        idx, prefetch_idx, seed = self._unpack_index(index)
         scene_id = self.samples[idx]["scene_id"]
+        if prefetch_idx is not None:
+            self.scene_data.prefetch([self.samples[prefetch_idx]["scene_id"]])
         object_id = int(self.samples[idx]["object_id"])
 
-        # get pc
-        mesh_vertices = self.scene_data[scene_id]["mesh_vertices"]
-        instance_bboxes = self.scene_data[scene_id]["instance_bboxes"]
-
-        if not self.use_color:
-            point_cloud = mesh_vertices[:, 0:3]  # do not use color for now
-            pcl_color = mesh_vertices[:, 3:6]
-        else:
-            point_cloud = mesh_vertices[:, 0:6]
-            point_cloud[:, 3:] = (point_cloud[:, 3:] - MEAN_COLOR_RGB) / 256.0
-            pcl_color = point_cloud[:, 3:]
-
-        if self.use_normal:
-            normals = mesh_vertices[:, 6:9]
-            point_cloud = np.concatenate([point_cloud, normals], 1)
-
-        if self.use_multiview:
-            # load multiview database
-            pid = mp.current_process().pid
-            if pid not in self.multiview_data:
-                self.multiview_data[pid] = h5py.File(MULTIVIEW_DATA, "r", libver="latest")
-
-            multiview = self.multiview_data[pid][scene_id]
-            point_cloud = np.concatenate([point_cloud, multiview], 1)
-
-        if self.use_height:
-            floor_height = np.percentile(point_cloud[:, 2], 0.99)
-            height = point_cloud[:, 2] - floor_height
-            point_cloud = np.concatenate([point_cloud, np.expand_dims(height, 1)], 1)
+        # get pc, sampled and augmented together with all boxes of the scene
+        point_cloud, pcl_color, instance_bboxes = self._get_scene_sample(scene_id, seed)
 
         # ------------------------------- LABELS ------------------------------
-        bbox = instance_bboxes[instance_bboxes[:, 7] == object_id, :]
+        bbox = instance_bboxes[[self.scene_data.get_object_row(scene_id, object_id)]]
         class_label = bbox[0, 6]
-
-        point_cloud, choices = random_sampling(point_cloud, self.num_points, return_choices=True)
-        pcl_color = pcl_color[choices]
-
         target_bboxes = bbox[:, 0:6]
 
-        # ------------------------------- DATA AUGMENTATION ------------------------------
-        if self.augment:
-            if np.random.random() > 0.5:
-                # Flipping along the YZ plane
-                point_cloud[:, 0] = -1 * point_cloud[:, 0]
-                target_bboxes[:, 0] = -1 * target_bboxes[:, 0]
-
-            if np.random.random() > 0.5:
-                # Flipping along the XZ plane
-                point_cloud[:, 1] = -1 * point_cloud[:, 1]
-                target_bboxes[:, 1] = -1 * target_bboxes[:, 1]
-
-                # Rotation along X-axis
-            rot_angle = (np.random.random() * np.pi / 18) - np.pi / 36  # -5 ~ +5 degree
-            rot_mat = rotx(rot_angle)
-            point_cloud[:, 0:3] = np.dot(point_cloud[:, 0:3], np.transpose(rot_mat))
-            target_bboxes = rotate_aligned_boxes_along_axis(target_bboxes, rot_mat, "x")
-
-            # Rotation along Y-axis
-            rot_angle = (np.random.random() * np.pi / 18) - np.pi / 36  # -5 ~ +5 degree
-            rot_mat = roty(rot_angle)
-            point_cloud[:, 0:3] = np.dot(point_cloud[:, 0:3], np.transpose(rot_mat))
-            target_bboxes = rotate_aligned_boxes_along_axis(target_bboxes, rot_mat, "y")
-
-            # Rotation along up-axis/Z-axis
-            rot_angle = (np.random.random() * np.pi / 18) - np.pi / 36  # -5 ~ +5 degree
-            rot_mat = rotz(rot_angle)
-            point_cloud[:, 0:3] = np.dot(point_cloud[:, 0:3], np.transpose(rot_mat))
-            target_bboxes = rotate_aligned_boxes_along_axis(target_bboxes, rot_mat, "z")
-
-            # Translation
-            point_cloud, target_bboxes = self._translate(point_cloud, target_bboxes)
-
         data_dict = {}
         data_dict["scan_idx"] = np.array(idx).astype(np.int64)
         data_dict["point_clouds"] = point_cloud.astype(np.float32)  # point cloud data including features
@@ -143,10 +93,63 @@ class ScannetPretrainDataset(Dataset):
         data_dict["ref_nyu40_label"] = np.array(int(class_label)).astype(np.int64)
         data_dict["object_id"] = np.array(int(object_id)).astype(np.int64)
         data_dict["pcl_color"] = pcl_color
+        if seed is not None:
+            data_dict["scene_seed"] = np.array(seed).astype(np.int64) # samples with the same seed share their point cloud
         data_dict["load_time"] = time.time() - start
 
         return data_dict
 
+    def get_scene_ids(self):
+        """
+        Scene id of every sample, see SceneBatchSampler.
+        """
+        return [sample["scene_id"] for sample in self.samples]
+
+    def _get_scene_sample(self, scene_id, seed=None):
+        """
+        Sampled point cloud of a scene, its colors and all boxes of the scene, augmented alike.
+        Draws with the same seed are identical, so the last one of this worker is reused.
+        """
+        if seed is not None and self._last_sample is not None and self._last_sample[0] == (scene_id, seed):
+            return self._last_sample[1]
+
+        rng = np.random.RandomState(seed) if seed is not None else np.random
+        if self.bank is not None:
+            # pre-sampled and pre-augmented variant of the scene
+            sample = self.bank.sample(scene_id, rng)
+        else:
+            # sample first, then gather only the sampled rows of every source
+            scene = self.scene_data[scene_id]
+            choices = sample_choices(scene["xyz"].shape[0], self.num_points, rng)
+            multiview = self._get_multiview(scene_id) if self.use_multiview else None
+            floor_height = self.scene_data.get_floor_height(scene_id) if self.use_height else None
+            point_cloud, pcl_color = gather_point_cloud(scene, choices, self.use_color, self.use_normal, multiview, floor_height)
+
+            instance_bboxes = np.array(scene["instance_bboxes"])
+            if self.augment:
+                point_cloud, instance_bboxes[:, 0:6] = augment_point_cloud(point_cloud, instance_bboxes[:, 0:6], rng)
+            sample = (point_cloud, pcl_color, instance_bboxes)
+
+        if seed is not None:
+            self._last_sample = ((scene_id, seed), sample)
+
+        return sample
+
+    def _get_multiview(self, scene_id):
+        # h5py handles do not survive a fork, open one per worker
+        pid = mp.current_process().pid
+        if pid not in self.multiview_data:
+            self.multiview_data[pid] = h5py.File(MULTIVIEW_DATA, "r", libver="latest")
+
+        return self.multiview_data[pid][scene_id]
+
+    def _unpack_index(self, index):
+        # ScenePrefetchSampler passes (idx, prefetch_idx) pairs, SceneBatchSampler (idx, prefetch_idx, seed)
+        if isinstance(index, tuple):
+            return tuple(index) + (None,) * (3 - len(index))
+
+        return index, None, None
+
     def _get_raw2label(self):
         # mapping
         scannet_labels = DC.type2class.keys()
@@ -175,16 +178,19 @@ class ScannetPretrainDataset(Dataset):
 
         self.samples = []
 
-        # load scene data
-        self.scene_data = {}
-        for scene_id in self.scene_list:
-            self.scene_data[scene_id] = {}
-            self.scene_data[scene_id]["mesh_vertices"] = np.load(
-                os.path.join(CONF.PATH.SCANNET_DATA, scene_id) + "_vert.npy")
-            self.scene_data[scene_id]["instance_bboxes"] = np.load(
-                os.path.join(CONF.PATH.SCANNET_DATA, scene_id) + "_bbox.npy")
+        # load scene data, memory-mapped or on demand in lazy mode
+        columns = ["xyz", "rgb"] + (["color"] if self.use_color else []) + (["normal"] if self.use_normal else [])
+        self.scene_data = SceneStore(self.scene_list, archive_path=self.scene_archive, columns=columns, lazy=self.lazy_scenes, cache_bytes=self.scene_cache_bytes)
 
-            samples = [{"scene_id": scene_id, "object_id": self.scene_data[scene_id]["instance_bboxes"][i, 7], "class_label": self.scene_data[scene_id]["instance_bboxes"][i, 6]} for i in range(self.scene_data[scene_id]["instance_bboxes"].shape[0])]
+        # pre-sampled and pre-augmented scene variants
+        self.bank = None
+        if self.augment_bank is not None:
+            self.bank = AugmentationBank(self.augment_bank)
+            self.bank.check(self.scene_list, num_points=self.num_points, use_color=self.use_color, use_normal=self.use_normal,
+                use_multiview=self.use_multiview, use_height=self.use_height)
+        for scene_id in self.scene_list:
+            instance_bboxes = self.scene_data.get_bboxes(scene_id)
+            samples = [{"scene_id": scene_id, "object_id": instance_bboxes[i, 7], "class_label": instance_bboxes[i, 6]} for i in range(instance_bboxes.shape[0])]
             self.samples.extend(samples)
 
         # # load multiview database
@@ -204,20 +210,3 @@ class ScannetPretrainDataset(Dataset):
         # store
         self.raw2nyuid = raw2nyuid
         self.raw2label = self._get_raw2label()
-
-    def _translate(self, point_set, bbox):
-        # unpack
-        coords = point_set[:, :3]
-
-        # translation factors
-        x_factor = np.random.choice(np.arange(-0.5, 0.501, 0.001), size=1)[0]
-        y_factor = np.random.choice(np.arange(-0.5, 0.501, 0.001), size=1)[0]
-        z_factor = np.random.choice(np.arange(-0.5, 0.501, 0.001), size=1)[0]
-        factor = [x_factor, y_factor, z_factor]
-
-        # dump
-        coords += factor
-        point_set[:, :3] = coords
-        bbox[:, :3] += factor
-
-        return point_set, bbox
@@ -0,0 +1,403 @@
+import os
+import sys
+import threading
+import torch
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.data import Sampler
+from torch.utils.data.dataloader import default_collate
+
+sys.path.append(os.path.join(os.getcwd(), "lib")) # HACK add the lib folder
+from lib.config import CONF
+from data.scannet.scannet_archive import SceneArchive, MEAN_COLOR_RGB, floor_height
+
+# rows of an h5py dataset read at once by read_rows()
+READ_CHUNK_ROWS = 1 << 13
+
+# column layout of <scene>_vert.npy
+VERTEX_COLUMNS = {
+    "xyz": slice(0, 3),
+    "rgb": slice(3, 6),
+    "normal": slice(6, 9)
+}
+
+
+def sample_choices(num_points, num_sample, rng=np.random):
+    """
+    Draw the point indices for one sample, like utils.pc_utils.random_sampling: without replacement
+    unless the scene has fewer points than num_sample.
+
+    Without replacement, the indices of the num_sample smallest of num_points uniform keys are a uniform
+    subset, found with argpartition instead of the full permutation rng.choice draws.
+    """
+    if num_points < num_sample:
+        return rng.randint(num_points, size=num_sample)
+
+    return rng.random_sample(num_points).argpartition(num_sample - 1)[:num_sample]
+
+
+def read_rows(data, choices, max_fraction=0.1, chunk_rows=READ_CHUNK_ROWS):
+    """
+    Rows `choices` of an array or h5py dataset.
+
+    h5py only accepts increasing, unique indices and point selections get slow when many rows
+    are selected, so sparse selections are read as sorted unique rows and dense ones as contiguous
+    slices of chunk_rows rows covering them, keeping only the selected rows of each slice. At most
+    one slice besides the result is in memory.
+    """
+    if isinstance(data, np.ndarray):
+        return data[choices]
+
+    rows, inverse = np.unique(choices, return_inverse=True)
+    if len(rows) <= max_fraction * data.shape[0]:
+        return data[rows][inverse]
+
+    selected = np.empty((len(rows),) + tuple(data.shape[1:]), dtype=data.dtype)
+    # selected rows of every chunk_rows-wide window starting at the first one
+    bounds = np.append(np.searchsorted(rows, np.arange(rows[0], rows[-1] + 1, chunk_rows)), len(rows))
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        if first == last:
+            continue
+        chunk = data[rows[first]:rows[last - 1] + 1]
+        selected[first:last] = chunk[rows[first:last] - rows[first]]
+
+    return selected[inverse]
+
+
+def gather_point_cloud(scene, choices, use_color=False, use_normal=False, multiview=None, floor_height=None):
+    """
+    Point cloud [xyz, (color), (normal), (multiview), (height)] of the sampled points only.
+    Multiview features are gathered row-wise from a memmap (MultiviewStore) or read in bounded
+    chunks from h5py (read_rows()), never as one (num_vertices, 128) matrix.
+
+    :param scene: scene dict from SceneStore
+    :param choices: sampled point indices, see sample_choices()
+    :param multiview: per-vertex multiview features (array or h5py dataset), or None
+    :param floor_height: floor height of the whole scene, appends the height feature if given
+    :return: point cloud (num_sample, C) float32, colors of the sampled points (num_sample, 3) float32
+    """
+    xyz = scene["xyz"][choices]
+    if not use_color:
+        pcl_color = scene["rgb"][choices]
+    elif "color" in scene:
+        pcl_color = scene["color"][choices]
+    else:
+        pcl_color = (scene["rgb"][choices] - MEAN_COLOR_RGB) / 256.0
+    features = [xyz]
+    if use_color:
+        features.append(pcl_color)
+    if use_normal:
+        features.append(scene["normal"][choices])
+    if multiview is not None:
+        features.append(read_rows(multiview, choices))
+    if floor_height is not None:
+        features.append(np.expand_dims(xyz[:, 2].astype(np.float64) - floor_height, 1))
+
+    num_channels = sum(feature.shape[1] for feature in features)
+    point_cloud = np.empty((len(choices), num_channels), dtype=np.float32)
+    start = 0
+    for feature in features:
+        point_cloud[:, start:start + feature.shape[1]] = feature
+        start += feature.shape[1]
+
+    return point_cloud, pcl_color.astype(np.float32)
+
+
+class SceneStore():
+    """
+    Read-only store for the preprocessed ScanNet scenes.
+
+    Scenes are read either from the per-scene .npy files in data_dir or, if archive_path is given,
+    from a consolidated archive (see data/scannet/scannet_archive.py). A scene is a dict with one
+    array per requested vertex column ("xyz", "rgb", "normal") plus "instance_bboxes". The derived
+    column "color" (normalized rgb) is only served from archives that store it, callers fall back
+    to normalizing "rgb" themselves. Floor heights and object_id -> bbox row lookups are computed
+    (or read from the archive) once per scene.
+
+    In the default mode the arrays are memory-mapped instead of loaded, so the data lives in the
+    page cache once and is shared by the parent process and every DataLoader worker. With an archive
+    the columns are stored apart, so columns that are never requested are never read.
+
+    In lazy mode nothing but the (small) bounding boxes is touched up front. Vertex columns are read on
+    first access and kept in an LRU cache bounded by cache_bytes (per process), and prefetch()
+    loads upcoming scenes on a background thread pool.
+
+    Arrays handed out by the store are read-only, callers must copy before modifying them.
+    """
+
+    def __init__(self, scene_list, data_dir=CONF.PATH.SCANNET_DATA, archive_path=None, columns=("xyz", "rgb", "normal"),
+                 lazy=False, cache_bytes=4 * 1024 ** 3, num_threads=4):
+        self.scene_list = list(scene_list)
+        self.data_dir = data_dir
+        self.archive_path = archive_path
+        self.columns = list(columns)
+        self.lazy = lazy
+        self.cache_bytes = cache_bytes
+        self.num_threads = num_threads
+
+        self._scenes = {}
+        self._bboxes = {}
+        self._floor_heights = {}
+        self._object_rows = {}
+        self._open()
+
+    def __len__(self):
+        return len(self.scene_list)
+
+    def __contains__(self, scene_id):
+        return scene_id in self._bboxes
+
+    def __getitem__(self, scene_id):
+        if not self.lazy:
+            return self._scenes[scene_id]
+
+        scene = dict(self._get_vertices(scene_id))
+        scene["instance_bboxes"] = self.get_bboxes(scene_id)
+
+        return scene
+
+    def keys(self):
+        return self._bboxes.keys()
+
+    def get_bboxes(self, scene_id):
+        """
+        Bounding boxes of one scene, without touching its vertices.
+        """
+        bboxes = self._bboxes[scene_id]
+        if bboxes is None:
+            bboxes = self._read_bboxes(scene_id, mmap=False)
+            self._bboxes[scene_id] = bboxes
+
+        return bboxes
+
+    def get_floor_height(self, scene_id):
+        """
+        Floor height of one scene, computed once and reused afterwards.
+        """
+        if scene_id not in self._floor_heights:
+            height = self._archive.floor_height(scene_id) if self._archive is not None else None
+            if height is None:
+                xyz = self[scene_id]["xyz"] if "xyz" in self.columns else self._read_column(scene_id, "xyz")
+                height = floor_height(xyz)
+            self._floor_heights[scene_id] = height
+
+        return self._floor_heights[scene_id]
+
+    def get_object_row(self, scene_id, object_id):
+        """
+        Row of object_id in the bounding boxes of scene_id.
+        """
+        if scene_id not in self._object_rows:
+            bboxes = self.get_bboxes(scene_id)
+            self._object_rows[scene_id] = {int(object_id): row for row, object_id in enumerate(bboxes[:, 7])}
+
+        return self._object_rows[scene_id][int(object_id)]
+
+    def prefetch(self, scene_ids):
+        """
+        Start loading the given scenes in the background, no-op outside of lazy mode.
+        """
+        if not self.lazy:
+            return
+
+        self._check_process()
+        for scene_id in scene_ids:
+            with self._lock:
+                if scene_id in self._cache or scene_id in self._pending:
+                    continue
+                self._pending[scene_id] = self._pool.submit(self._load_vertices, scene_id)
+
+    def __getstate__(self):
+        # memmaps would be pickled as full in-memory copies, reopen them on the other side instead
+        state = self.__dict__.copy()
+        state["_scenes"] = {}
+        state["_bboxes"] = {}
+        for key in ["_archive", "_cache", "_cache_size", "_pending", "_lock", "_pool", "_pid"]:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def _open(self):
+        self._archive = SceneArchive(self.archive_path) if self.archive_path is not None else None
+        if not self.lazy:
+            for scene_id in self.scene_list:
+                self._scenes[scene_id] = self._read_vertices(scene_id, mmap=True)
+                self._scenes[scene_id]["instance_bboxes"] = self._read_bboxes(scene_id, mmap=True)
+                self._bboxes[scene_id] = self._scenes[scene_id]["instance_bboxes"]
+        else:
+            for scene_id in self.scene_list:
+                self._bboxes[scene_id] = None
+            self._pid = None
+
+    def _read_column(self, scene_id, column):
+        if self._archive is not None:
+            return self._archive.get(scene_id, column)
+
+        return np.load(os.path.join(self.data_dir, scene_id) + "_vert.npy", mmap_mode="r")[:, VERTEX_COLUMNS[column]]
+
+    def _read_vertices(self, scene_id, mmap):
+        if self._archive is not None:
+            columns = [column for column in self.columns if column in self._archive.columns]
+            scene = {column: self._archive.get(scene_id, column) for column in columns}
+            if not mmap:
+                scene = {column: np.array(data) for column, data in scene.items()}
+        else:
+            vertices = np.load(os.path.join(self.data_dir, scene_id) + "_vert.npy", mmap_mode="r" if mmap else None)
+            scene = {column: vertices[:, VERTEX_COLUMNS[column]] for column in self.columns if column in VERTEX_COLUMNS}
+            if not mmap:
+                scene = {column: np.ascontiguousarray(data) for column, data in scene.items()}
+
+        for data in scene.values():
+            data.setflags(write=False)
+
+        return scene
+
+    def _read_bboxes(self, scene_id, mmap):
+        if self._archive is not None:
+            bboxes = self._archive.get(scene_id, "bbox")
+            if not mmap:
+                bboxes = np.array(bboxes)
+        else:
+            bboxes = np.load(os.path.join(self.data_dir, scene_id) + "_bbox.npy", mmap_mode="r" if mmap else None)
+        bboxes.setflags(write=False)
+
+        return bboxes
+
+    def _check_process(self):
+        # locks and thread pools do not survive a fork, every worker sets up its own
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self._pool = ThreadPoolExecutor(max_workers=self.num_threads)
+            self._cache = OrderedDict()
+            self._cache_size = 0
+            self._pending = {}
+
+    def _get_vertices(self, scene_id):
+        self._check_process()
+        with self._lock:
+            if scene_id in self._cache:
+                self._cache.move_to_end(scene_id)
+                return self._cache[scene_id]
+            future = self._pending.get(scene_id)
+
+        if future is not None:
+            return future.result()
+
+        return self._load_vertices(scene_id)
+
+    def _load_vertices(self, scene_id):
+        scene = self._read_vertices(scene_id, mmap=False)
+        nbytes = sum(data.nbytes for data in scene.values())
+
+        with self._lock:
+            self._pending.pop(scene_id, None)
+            if scene_id not in self._cache:
+                self._cache[scene_id] = scene
+                self._cache_size += nbytes
+
+            # evict least recently used scenes, but always keep the one just loaded
+            while self._cache_size > self.cache_bytes and len(self._cache) > 1:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_size -= sum(data.nbytes for data in evicted.values())
+
+            return self._cache[scene_id] if scene_id in self._cache else scene
+
+
+class ScenePrefetchSampler(Sampler):
+    """
+    Wraps a sampler and pairs every index with the index drawn `stride` positions later,
+    so the dataset can prefetch the scene it will be asked for next.
+
+    With the default DataLoader batches are handed to the workers round-robin, so a stride of
+    batch_size * num_workers points every worker at its own next batch.
+    """
+
+    def __init__(self, sampler, stride):
+        self.sampler = sampler
+        self.stride = stride
+
+    def __iter__(self):
+        order = list(iter(self.sampler))
+        for i, idx in enumerate(order):
+            prefetch_idx = order[i + self.stride] if i + self.stride < len(order) else None
+            yield (idx, prefetch_idx)
+
+    def __len__(self):
+        return len(self.sampler)
+
+
+class SceneBatchSampler(Sampler):
+    """
+    Batch sampler that puts samples of the same scene into the same batch.
+
+    Every epoch the samples of each scene are shuffled and cut into groups of at most samples_per_scene.
+    Each group gets its own seed, so all its samples are drawn from the same sampled and augmented
+    point cloud. The groups are shuffled and packed into batches of batch_size. Use it with
+    collate_scene_batch() to transfer that point cloud once per batch.
+
+    Indices are yielded as (idx, prefetch_idx, seed), prefetch_idx is the index `stride` samples later
+    (see ScenePrefetchSampler) or None.
+    """
+
+    def __init__(self, scene_ids, batch_size, samples_per_scene=None, drop_last=True, stride=None):
+        self.batch_size = batch_size
+        self.samples_per_scene = samples_per_scene if samples_per_scene is not None else batch_size
+        self.drop_last = drop_last
+        self.stride = stride
+        self.num_samples = len(scene_ids)
+
+        self.scenes = OrderedDict()
+        for idx, scene_id in enumerate(scene_ids):
+            if scene_id not in self.scenes:
+                self.scenes[scene_id] = []
+            self.scenes[scene_id].append(idx)
+
+    def __iter__(self):
+        groups = []
+        for indices in self.scenes.values():
+            indices = np.random.permutation(indices).tolist()
+            for start in range(0, len(indices), self.samples_per_scene):
+                groups.append(indices[start:start + self.samples_per_scene])
+
+        # distinct seeds within an epoch
+        seeds = np.random.randint(0, 2 ** 31 - 1 - len(groups)) + np.arange(len(groups))
+        order = [(idx, int(seeds[group_id])) for group_id in np.random.permutation(len(groups)) for idx in groups[group_id]]
+
+        for start in range(0, len(order), self.batch_size):
+            if self.drop_last and start + self.batch_size > len(order):
+                break
+            batch = []
+            for i in range(start, min(start + self.batch_size, len(order))):
+                idx, seed = order[i]
+                prefetch_idx = order[i + self.stride][0] if self.stride is not None and i + self.stride < len(order) else None
+                batch.append((idx, prefetch_idx, seed))
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+
+def collate_scene_batch(batch):
+    """
+    Collate samples drawn with SceneBatchSampler: "point_clouds" holds one point cloud per distinct
+    "scene_seed" in the batch, and "scene_inds" maps every sample to its point cloud.
+    """
+    positions = OrderedDict()
+    for i, sample in enumerate(batch):
+        seed = int(sample["scene_seed"])
+        if seed not in positions:
+            positions[seed] = (len(positions), i)
+
+    data_dict = default_collate([{key: value for key, value in sample.items() if key != "point_clouds"} for sample in batch])
+    data_dict["point_clouds"] = torch.from_numpy(np.stack([batch[i]["point_clouds"] for _, i in positions.values()]))
+    data_dict["scene_inds"] = torch.LongTensor([positions[int(sample["scene_seed"])][0] for sample in batch])
+
+    return data_dict
@@ -8,13 +8,15 @@ import sys
 import time
 import torch
 import numpy as np
+import multiprocessing as mp
 from tqdm import tqdm
 from tensorboardX import SummaryWriter
 
 
 sys.path.append(os.path.join(os.getcwd(), "lib")) # HACK add the lib folder
 from lib.config import CONF
-from lib.loss_helper import caption_loss, attention_regularization
+from lib.loss_helper import caption_loss, caption_metric_inputs, caption_metrics, attention_regularization
+from lib.encoder_pipeline import EncoderPipeline
 from utils.eta import decode_eta
 from utils.utils_lstm import clip_gradient
 
@@ -55,6 +57,8 @@ EPOCH_REPORT_TEMPLATE = """
 
 """
 
+METRIC_KEYS = ["bleu4", "meteor", "rouge", "cider", "attention_max", "attention_var", "caption_ratio"]
+
 BEST_REPORT_TEMPLATE = """
 --------------------------------------best--------------------------------------
 [best] epoch: {epoch}
@@ -69,7 +73,8 @@ BEST_REPORT_TEMPLATE = """
 """
 
 class SolverCaptioning():
-    def __init__(self, model, config, dataloader, optimizer, stamp, vocabulary, attention=False, val_step=10, early_stopping=-1, only_val=False, gradient_clip=None):
+    def __init__(self, model, config, dataloader, optimizer, stamp, vocabulary, attention=False, val_step=10, early_stopping=-1, only_val=False, gradient_clip=None, augmentation=None, pipeline=False,
+                 metric_step=None, metric_workers=0, cider_document_frequency=None):
         self.epoch = 0                    # set in __call__
         self.verbose = 0                  # set in __call__
         
@@ -78,6 +83,15 @@ class SolverCaptioning():
         self.dataloader = dataloader
         self.optimizer = optimizer
         self.stamp = stamp
+        self.augmentation = augmentation
+        self.pipeline = pipeline
+        # caption metrics every N iterations per phase (0 disables them), computed in metric_workers processes
+        self.metric_step = metric_step if metric_step is not None else {"train": 1, "val": 1}
+        if self.metric_step.get("val", 0) <= 0:
+            raise ValueError("validation needs caption metrics, bleu4 selects the best model")
+        self.metric_workers = metric_workers
+        # corpus CIDEr document frequencies, loaded once by every process computing metrics
+        self.cider_document_frequency = cider_document_frequency
         self.val_step = val_step
         self.early_stopping = early_stopping
         self.no_improve = 0
@@ -141,6 +155,13 @@ class SolverCaptioning():
         self._running_log = {}
         self._global_iter_id = 0
         self._total_iter = {}             # set in __call__
+        self._pipeline = {}               # set in __call__
+        self._metric_iter = {"train": 0, "val": 0}
+        self._pending_metrics = {"train": [], "val": []}
+        self._metric_pool = None
+        if self.metric_workers > 0:
+            # spawn, the workers must not inherit the cuda context of the training process
+            self._metric_pool = mp.get_context("spawn").Pool(self.metric_workers)
 
         # templates
         self.__iter_report_template = ITER_REPORT_TEMPLATE
@@ -154,11 +175,20 @@ class SolverCaptioning():
         self._total_iter["train"] = len(self.dataloader["train"]) * epoch
         self._total_iter["val"] = len(self.dataloader["val"]) * self.val_step
 
+        if self.pipeline:
+            # one encoder worker per phase, validation runs in the middle of a training epoch
+            self._pipeline = {
+                "train": EncoderPipeline(self.model, self.augmentation),
+                "val": EncoderPipeline(self.model)
+            }
+
         if self.only_val:
             self._log("evaluating...")
             self._feed(self.dataloader["val"], "val", 0)
             self._log("finished")
             self._best_report()
+            self._close_pipeline()
+            self._close_metric_pool()
             return
         
         for epoch_id in range(epoch):
@@ -224,26 +254,28 @@ class SolverCaptioning():
         # Reset log
         for key in self.log[phase]:
             self.log[phase][key] = []
+        # every pass samples its first batch, a validation always has bleu4 to compare
+        self._metric_iter[phase] = 0
 
         # change dataloader
         dataloader = dataloader if phase == "train" else tqdm(dataloader)
+        if self._pipeline:
+            # batches come back from the encoder worker augmented and encoded
+            dataloader = self._pipeline[phase](dataloader, augment=phase == "train")
 
         for data_dict in dataloader:
             # move to cuda
             for key in data_dict:
                 data_dict[key] = data_dict[key].cuda()
 
+            # augment the whole batch on the gpu
+            if phase == "train" and self.augmentation is not None and not self._pipeline:
+                data_dict = self.augmentation(data_dict)
+
             # initialize the running loss
             self._running_log = {
                 # loss
                 "loss": 0,
-                # acc
-                "bleu4": 0,
-                "meteor": 0,
-                "rouge": 0,
-                "cider": 0, 
-                "attention_max":0,
-                "caption_ratio":0
             }
 
             # load
@@ -264,19 +296,13 @@ class SolverCaptioning():
             
             # eval
             start = time.time()
-            self._eval(data_dict)
+            self._eval(data_dict, phase)
             self.log[phase]["eval"].append(time.time() - start)
 
-            # record log
-            self.log[phase]["loss"].append(self._running_log["loss"].item())
-
-            self.log[phase]["bleu4"].append(self._running_log["bleu4"])
-            self.log[phase]["meteor"].append(self._running_log["meteor"])
-            self.log[phase]["rouge"].append(self._running_log["rouge"])
-            self.log[phase]["cider"].append(self._running_log["cider"])
-            self.log[phase]["attention_max"].append(self._running_log["attention_max"])
-            self.log[phase]["attention_var"].append(self._running_log["attention_var"])
-            self.log[phase]["caption_ratio"].append(self._running_log["caption_ratio"])
+            # record log, metrics are added once they are computed
+            if self._running_log["loss"] is not None:
+                self.log[phase]["loss"].append(self._running_log["loss"].item())
+            self._collect_metrics(phase)
     
             # report
             if phase == "train":
@@ -305,6 +331,8 @@ class SolverCaptioning():
                     return
 
 
+        self._collect_metrics(phase, wait=True)
+
         # check best
         if phase == "val":
             cur_criterion = "bleu4"
@@ -312,10 +340,11 @@ class SolverCaptioning():
             cur_best = np.mean(self.log[phase][cur_criterion])
             if cur_best > self.best[cur_criterion] or self.only_val:
                 self._log("best {} achieved: {}".format(cur_criterion, cur_best))
-                self._log("current train_loss: {}".format(np.mean(self.log["train"]["loss"])))
-                self._log("current val_loss: {}".format(np.mean(self.log["val"]["loss"])))
+                self._log("current train_loss: {}".format(self._report_mean("train", "loss")))
+                self._log("current val_loss: {}".format(self._report_mean("val", "loss")))
                 self.best["epoch"] = epoch_id + 1
-                self.best["loss"] = np.mean(self.log[phase]["loss"])
+                # no validation loss without decoder scores
+                self.best["loss"] = np.mean(self.log[phase]["loss"]) if len(self.log[phase]["loss"]) > 0 else None
                 self.best["bleu4"] = np.mean(self.log[phase]["bleu4"])
                 self.best["meteor"] = np.mean(self.log[phase]["meteor"])
                 self.best["rouge"] = np.mean(self.log[phase]["rouge"])
@@ -339,15 +368,34 @@ class SolverCaptioning():
                     self.stop = True
                     self._log(f"early stopping because no improvements were achieved after {self.no_improve} validations...\n")
 
-    def _eval(self, data_dict):
-        # dump
-        self._running_log["bleu4"] = data_dict["bleu4"]
-        self._running_log["meteor"] = data_dict["meteor"]
-        self._running_log["rouge"] = data_dict["rouge"]
-        self._running_log["cider"] = data_dict["cider"]
-        self._running_log["attention_max"] = data_dict["attention_max"]
-        self._running_log["attention_var"] = data_dict["attention_var"]
-        self._running_log["caption_ratio"] = data_dict["caption_ratio"]
+    def _eval(self, data_dict, phase):
+        # sample the metrics every metric_step iterations
+        step = self.metric_step.get(phase, 0)
+        self._metric_iter[phase] += 1
+        if step <= 0 or (self._metric_iter[phase] - 1) % step != 0:
+            return
+
+        inputs = caption_metric_inputs(data_dict)
+        if self._metric_pool is not None:
+            self._pending_metrics[phase].append(self._metric_pool.apply_async(caption_metrics, (inputs, self.vocabulary, self.cider_document_frequency)))
+        else:
+            self._add_metrics(phase, caption_metrics(inputs, self.vocabulary, self.cider_document_frequency))
+
+    def _collect_metrics(self, phase, wait=False):
+        """
+        Log the metrics of the worker pool that are done, or all of them if wait.
+        """
+        pending = []
+        for result in self._pending_metrics[phase]:
+            if wait or result.ready():
+                self._add_metrics(phase, result.get())
+            else:
+                pending.append(result)
+        self._pending_metrics[phase] = pending
+
+    def _add_metrics(self, phase, metrics):
+        for key in METRIC_KEYS:
+            self.log[phase][key].append(metrics[key])
 
     def _dump_log(self, phase):
         log = {
@@ -363,15 +411,31 @@ class SolverCaptioning():
         }
         for key in log:
             for item in log[key]:
+                # metrics of a phase can be off (metric_step 0)
+                if len(self.log[phase][item]) == 0:
+                    continue
                 self._log_writer[phase].add_scalar(
                     "{}/{}".format(key, item),
                     np.mean([v for v in self.log[phase][item]]),
                     self._global_iter_id
                 )
 
+    def _close_metric_pool(self):
+        if self._metric_pool is not None:
+            self._metric_pool.close()
+            self._metric_pool.join()
+            self._metric_pool = None
+
+    def _close_pipeline(self):
+        for pipeline in self._pipeline.values():
+            pipeline.close()
+        self._pipeline = {}
+
     def _finish(self, epoch_id):
         # print best
         self._best_report()
+        self._close_pipeline()
+        self._close_metric_pool()
 
         # save model
         self._log("saving last models...\n")
@@ -383,6 +447,12 @@ class SolverCaptioning():
             self._log_writer[phase].export_scalars_to_json(os.path.join(CONF.PATH.OUTPUT, self.stamp, "tensorboard/{}".format(phase), "all_scalars.json"))
             self._log_writer[phase].close()
 
+    def _report_mean(self, phase, key):
+        # metrics of a phase can be off (metric_step 0) and the validation loss needs decoder scores,
+        # report n/a instead of nan
+        values = self.log[phase][key]
+        return round(np.mean(values), 5) if len(values) > 0 else "n/a"
+
     def _train_report(self, epoch_id):
         # compute ETA
         fetch_time = self.log["train"]["fetch"]
@@ -403,12 +473,12 @@ class SolverCaptioning():
             iter_id=self._global_iter_id + 1,
             total_iter=self._total_iter["train"],
             train_loss=round(np.mean([v for v in self.log["train"]["loss"]]), 5),
-            train_bleu4=round(np.mean([v for v in self.log["train"]["bleu4"]]), 5),
-            train_meteor=round(np.mean([v for v in self.log["train"]["meteor"]]), 5),
-            train_rouge=round(np.mean([v for v in self.log["train"]["rouge"]]), 5),
-            train_cider=round(np.mean([v for v in self.log["train"]["cider"]]), 5),
-            train_attention_max=round(np.mean([v for v in self.log["train"]["attention_max"]]), 5),
-            train_attention_var=round(np.mean([v for v in self.log["train"]["attention_var"]]), 5),            
+            train_bleu4=self._report_mean("train", "bleu4"),
+            train_meteor=self._report_mean("train", "meteor"),
+            train_rouge=self._report_mean("train", "rouge"),
+            train_cider=self._report_mean("train", "cider"),
+            train_attention_max=self._report_mean("train", "attention_max"),
+            train_attention_var=self._report_mean("train", "attention_var"),            
             mean_fetch_time=round(np.mean(fetch_time), 5),
             mean_forward_time=round(np.mean(forward_time), 5),
             mean_backward_time=round(np.mean(backward_time), 5),
@@ -424,19 +494,19 @@ class SolverCaptioning():
         self._log("epoch [{}/{}] done...".format(epoch_id+1, self.epoch))
         epoch_report = self.__epoch_report_template.format(
             train_loss=round(np.mean([v for v in self.log["train"]["loss"]]), 5),
-            train_bleu4=round(np.mean([v for v in self.log["train"]["bleu4"]]), 5),
-            train_meteor=round(np.mean([v for v in self.log["train"]["meteor"]]), 5),
-            train_rouge=round(np.mean([v for v in self.log["train"]["rouge"]]), 5),
-            train_cider=round(np.mean([v for v in self.log["train"]["cider"]]), 5),
-            train_attention_max=round(np.mean([v for v in self.log["train"]["attention_max"]]), 5),
-            train_attention_var=round(np.mean([v for v in self.log["train"]["attention_var"]]), 5),
-            val_loss=round(np.mean([v for v in self.log["val"]["loss"]]), 5),
-            val_bleu4=round(np.mean([v for v in self.log["val"]["bleu4"]]), 5),
-            val_meteor=round(np.mean([v for v in self.log["val"]["meteor"]]), 5),
-            val_rouge=round(np.mean([v for v in self.log["val"]["rouge"]]), 5),
-            val_cider=round(np.mean([v for v in self.log["val"]["cider"]]), 5),
-            val_attention_max=round(np.mean([v for v in self.log["val"]["attention_max"]]), 5),
-            val_attention_var=round(np.mean([v for v in self.log["val"]["attention_var"]]), 5),
+            train_bleu4=self._report_mean("train", "bleu4"),
+            train_meteor=self._report_mean("train", "meteor"),
+            train_rouge=self._report_mean("train", "rouge"),
+            train_cider=self._report_mean("train", "cider"),
+            train_attention_max=self._report_mean("train", "attention_max"),
+            train_attention_var=self._report_mean("train", "attention_var"),
+            val_loss=self._report_mean("val", "loss"),
+            val_bleu4=self._report_mean("val", "bleu4"),
+            val_meteor=self._report_mean("val", "meteor"),
+            val_rouge=self._report_mean("val", "rouge"),
+            val_cider=self._report_mean("val", "cider"),
+            val_attention_max=self._report_mean("val", "attention_max"),
+            val_attention_var=self._report_mean("val", "attention_var"),
         )
         self._log(epoch_report)
     
@@ -444,7 +514,7 @@ class SolverCaptioning():
         self._log("training completed...")
         best_report = self.__best_report_template.format(
             epoch=self.best["epoch"],
-            loss=round(self.best["loss"], 5),
+            loss=round(self.best["loss"], 5) if self.best["loss"] is not None else "n/a",
             bleu4=round(self.best["bleu4"], 5),
             meteor=round(self.best["meteor"], 5),
             rouge=round(self.best["rouge"], 5),
@@ -46,7 +46,7 @@ BEST_REPORT_TEMPLATE = """
 """
 
 class SolverPretrain():
-    def __init__(self, model, config, dataloader, optimizer, stamp, val_step=10, early_stopping=-1):
+    def __init__(self, model, config, dataloader, optimizer, stamp, val_step=10, early_stopping=-1, augmentation=None):
         self.epoch = 0                    # set in __call__
         self.verbose = 0                  # set in __call__
         
@@ -55,6 +55,7 @@ class SolverPretrain():
         self.dataloader = dataloader
         self.optimizer = optimizer
         self.stamp = stamp
+        self.augmentation = augmentation
         self.val_step = val_step
         self.early_stopping = early_stopping
         self.no_improve = 0
@@ -182,6 +183,10 @@ class SolverPretrain():
             for key in data_dict:
                 data_dict[key] = data_dict[key].cuda()
 
+            # augment the whole batch on the gpu
+            if phase == "train" and self.augmentation is not None:
+                data_dict = self.augmentation(data_dict)
+
             # initialize the running loss
             self._running_log = {
                 # loss
@@ -1,9 +1,12 @@
 import torch
 from torch import nn
+from functools import partial
 import numpy as np
 import torchvision
 
 from lib.config import CONF
+from models.proposal_selection import select_proposals, gather_proposals
+from models.decoding import greedy_decode, beam_search, expand_beams
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -15,13 +18,16 @@ class Attentive_Decoder(nn.Module):
 
     def __init__(self, vocab_list, embedding_dict, attention_dim=512, embed_dim=300, vote_dimension=128,
                  object_proposals =128, encoder_dim=256+128, decoder_dim=512, dropout=0.5, objectness_thresh=0.75,
-                 n_closest=16):
+                 n_closest=16, beam_size=1, length_penalty=1.0, eval_scores=False):
         """
         :param embed_dim: embedding size
         :param decoder_dim: size of decoder's RNN
         :param vocab_size: size of vocabulary
         :param encoder_dim: feature size of encoded images
         :param dropout: dropout
+        :param beam_size: beam width at inference, 1 decodes greedily
+        :param length_penalty: exponent of the length normalization of beam search
+        :param eval_scores: return the scores of every greedy decoding step at inference, for a validation loss
         """
         super(Attentive_Decoder, self).__init__()
 
@@ -32,6 +38,9 @@ class Attentive_Decoder(nn.Module):
         self.object_proposals = object_proposals
         self.objectness_thresh =objectness_thresh
         self.n_closest = n_closest
+        self.beam_size = beam_size
+        self.length_penalty = length_penalty
+        self.eval_scores = eval_scores
         self.dropout = dropout
 
         # attention part 
@@ -90,15 +99,10 @@ class Attentive_Decoder(nn.Module):
         obj_features = data_dict["ref_obj_features"]
         target_caption = data_dict["lang_indices"]
         batch_size = obj_features.size(0)
-        objectness = torch.softmax(data_dict["objectness_scores"], dim=-1)[:, :, -1]
-        distance = torch.norm(data_dict["ref_center_label"].unsqueeze(1) - data_dict["aggregated_vote_xyz"], dim=2)
-        object_mask = objectness > self.objectness_thresh
-        distance[~object_mask] = float("inf")
-        max_distances = torch.max(torch.topk(distance, self.n_closest, dim=-1, largest=False)[0], dim=1, keepdim=True)[0]
-        distance_mask = distance <= max_distances
-        object_mask &= distance_mask
+        # attention only looks at the selected proposals, the initial state at all of them
+        proposal_inds, proposal_mask = select_proposals(data_dict, self.objectness_thresh, self.n_closest)
+        proposal_features = gather_proposals(aggregated_obj_features, proposal_inds)
 
-        
         target_caption_embeddings = self.idx2embedding[target_caption]
         target_caption_lengths = data_dict["lang_len"]
         
@@ -112,7 +116,12 @@ class Attentive_Decoder(nn.Module):
             aggregated_obj_features = aggregated_obj_features[sort_ind]
             obj_features = obj_features[sort_ind]
             target_caption_embeddings = target_caption_embeddings[sort_ind]
-            object_mask = object_mask[sort_ind]
+            proposal_features = proposal_features[sort_ind]
+            proposal_inds = proposal_inds[sort_ind]
+            proposal_mask = proposal_mask[sort_ind]
+
+            # the proposals do not change while decoding, project them once
+            encoder_att = self.attention.encoder_att(proposal_features)
 
             # Initialize LSTM state
             h, c = self.init_hidden_state(torch.cat([torch.mean(aggregated_obj_features,dim=1), obj_features], dim=1))  #(batch_size, decoder_dim)
@@ -127,15 +136,15 @@ class Attentive_Decoder(nn.Module):
 
             # Create tensors to hold word predicion scores
             predictions = obj_features.new_zeros((batch_size, self.vocab_size, target_caption.size(1)))
-            alphas = obj_features.new_zeros((batch_size, target_caption.size(1), self.object_proposals)) 
+            alphas = obj_features.new_zeros((batch_size, target_caption.size(1), self.n_closest))
             
 
             # At each time-step, decode by
             # then generate a new word in the decoder with the previous word
             for t in range(max(decode_lengths)):
                 batch_size_t = sum([l > t for l in decode_lengths])
-                attention_weighted_encoding, alpha = self.attention(aggregated_obj_features[:batch_size_t],
-                                                                h[:batch_size_t], object_mask)
+                attention_weighted_encoding, alpha = self.attention(proposal_features[:batch_size_t],
+                                                                h[:batch_size_t], proposal_mask[:batch_size_t], encoder_att[:batch_size_t])
                 gate = self.sigmoid(self.f_beta(h[:batch_size_t]))
                 attention_weighted_encoding = gate * attention_weighted_encoding
 
@@ -151,13 +160,15 @@ class Attentive_Decoder(nn.Module):
             #now we need to resort the output into its initial order
             _, orig_idx = sort_ind.sort(0)
             predictions_resorted = predictions[orig_idx]
-            alphas_resorted = alphas[orig_idx]
+            alphas_resorted = self._scatter_alphas(alphas, proposal_inds)[orig_idx]
             data_dict["alphas"] = alphas_resorted
             data_dict["caption_predictions"] = predictions_resorted
-            data_dict["object_mask"] = object_mask[orig_idx]
             
 
         else:
+            # the proposals do not change while decoding, project them once
+            encoder_att = self.attention.encoder_att(proposal_features)
+
             # init hidden, cell state & prediction
             h, c = self.init_hidden_state(torch.cat([torch.mean(aggregated_obj_features,dim=1), obj_features], dim=1))
 
@@ -169,59 +180,61 @@ class Attentive_Decoder(nn.Module):
             # predictions[:, 0] = wrd_idx
             # step = 1
 
-            predictions = obj_features.new_zeros((batch_size, CONF.TRAIN.MAX_DES_LEN), dtype=torch.int64) - 1
-            alphas = obj_features.new_zeros((batch_size, CONF.TRAIN.MAX_DES_LEN, self.object_proposals))
-            embedded_word = self.initial_embedding.expand(batch_size, -1)
-            step = 0
-
+            context = [proposal_features, proposal_mask, encoder_att, obj_features]
+            if self.beam_size > 1:
+                step = partial(self._greedy_step, *[expand_beams(tensor, self.beam_size) for tensor in context])
+                state = (expand_beams(h, self.beam_size), expand_beams(c, self.beam_size))
+                predictions, alphas, scores = beam_search(step, state, self.initial_embedding, self.idx2embedding, CONF.TRAIN.MAX_DES_LEN,
+                    self.beam_size, self.length_penalty)
+            else:
+                step = partial(self._greedy_step, *context)
+                predictions, alphas, scores = greedy_decode(step, (h, c), self.initial_embedding, self.idx2embedding, CONF.TRAIN.MAX_DES_LEN,
+                    return_scores=self.eval_scores)
 
-            incomplete_indices = [i for i in range(batch_size)]
+            data_dict["caption_indices"] = predictions
+            if scores is not None:
+                data_dict["caption_predictions"] = scores
+            data_dict["alphas"] = self._scatter_alphas(alphas, proposal_inds)
 
-            while True:
-                attention_weighted_encoding, alpha = self.attention(aggregated_obj_features[incomplete_indices], h, object_mask[incomplete_indices])
-                gate = self.sigmoid(self.f_beta(h))
-                attention_weighted_encoding = gate * attention_weighted_encoding
-                conc_encodings = torch.cat([attention_weighted_encoding, obj_features[incomplete_indices]], dim=1)
+        return data_dict
 
-                h, c = self.decode_step(
-                    torch.cat([embedded_word, conc_encodings], dim=1), (h,c))
-
-                prediction = self.fc(h)
-                wrd_idx = torch.argmax(prediction, dim=1)
-                embedded_word = self.idx2embedding[wrd_idx]
-
-                predictions[incomplete_indices, step] = wrd_idx
-                alphas[incomplete_indices, step, :] = alpha
-
-                keep_indices = wrd_idx != 0
-                h = h[keep_indices]
-                c = c[keep_indices]
-                embedded_word = embedded_word[keep_indices]
-                completed_indices = torch.nonzero(wrd_idx == 0).squeeze(-1).tolist()
-                completed_indices = [incomplete_indices[i] for i in completed_indices]
-                for c_i in completed_indices:
-                    incomplete_indices.remove(c_i)
-                
-                step += 1
-                if step >= CONF.TRAIN.MAX_DES_LEN or len(incomplete_indices) == 0: # we can think about this value
-                    break
+    def _greedy_step(self, proposal_features, proposal_mask, encoder_att, obj_features, embedded_word, state):
+        """
+        One decoding step for greedy_decode() and beam_search().
+        """
+        h, c = state
+        attention_weighted_encoding, alpha = self.attention(proposal_features, h, proposal_mask, encoder_att)
+        gate = self.sigmoid(self.f_beta(h))
+        attention_weighted_encoding = gate * attention_weighted_encoding
+        conc_encodings = torch.cat([attention_weighted_encoding, obj_features], dim=1)
 
+        h, c = self.decode_step(
+            torch.cat([embedded_word, conc_encodings], dim=1), (h,c))
 
+        return self.fc(h), (h, c), alpha
 
-            data_dict["caption_indices"] = predictions
-            scores = obj_features.new_zeros((batch_size, self.vocab_size, CONF.TRAIN.MAX_DES_LEN))
+    def _scatter_alphas(self, alphas, proposal_inds):
+        """
+        Attention weights of the selected proposals (batch_size, T, n_closest) back at their
+        proposal index (batch_size, T, object_proposals), zero for all other proposals.
+        """
+        proposal_inds = proposal_inds.unsqueeze(1).expand(-1, alphas.size(1), -1)
+        # padding slots carry zero weight, adding them leaves the proposal they point to unchanged
+        return alphas.new_zeros(alphas.shape[:2] + (self.object_proposals,)).scatter_add(2, proposal_inds, alphas)
 
+def masked_softmax(att, mask):
+    """
+    Softmax over the proposals selected by mask, zero weight everywhere else and for samples without any proposal.
 
-            # tmp = torch.tensor(predictions)
-            tmp = predictions.clone().detach()
-            tmp[tmp < 0] = 0
-            scores.scatter_(1, tmp.unsqueeze(1), 1)
+    :param att: (batch_size, num_pixels) attention scores
+    :param mask: (batch_size, num_pixels) bool tensor
+    """
+    # samples without a proposal keep finite scores, so neither alpha nor its gradient turns into nan
+    fill_mask = ~mask & mask.any(dim=1, keepdim=True)
+    alpha = torch.softmax(att.masked_fill(fill_mask, float("-inf")), dim=1)
 
-            data_dict["caption_predictions"] = scores
-            data_dict["alphas"] = alphas
-            data_dict["object_mask"] = object_mask
+    return alpha.masked_fill(~mask, 0)
 
-        return data_dict
 
 class Attention(nn.Module):
     """
@@ -239,24 +252,20 @@ class Attention(nn.Module):
         self.decoder_att = nn.Linear(decoder_dim, attention_dim)  # linear layer to transform decoder's output
         self.full_att = nn.Linear(attention_dim, 1)  # linear layer to calculate values to be softmax-ed
         self.relu = nn.ReLU()
-        self.softmax = nn.Softmax(dim=0)  # softmax layer to calculate weights
 
-    def forward(self, encoder_out, decoder_hidden, object_mask):
+    def forward(self, encoder_out, decoder_hidden, object_mask, encoder_att=None):
         """
         Forward propagation.
 
         :param encoder_out: encoded images, a tensor of dimension (batch_size, num_pixels, encoder_dim)
         :param decoder_hidden: previous decoder output, a tensor of dimension (batch_size, decoder_dim)
+        :param encoder_att: encoder_att(encoder_out) if already computed, a tensor of dimension (batch_size, num_pixels, attention_dim)
         :return: attention weighted encoding, weights
         """
-        att1 = self.encoder_att(encoder_out)  # (batch_size, num_pixels, attention_dim)
+        att1 = self.encoder_att(encoder_out) if encoder_att is None else encoder_att  # (batch_size, num_pixels, attention_dim)
         att2 = self.decoder_att(decoder_hidden)  # (batch_size, attention_dim)
         att = self.full_att(self.relu(att1 + att2.unsqueeze(1))).squeeze(2)  # (batch_size, num_pixels)
-        alpha = torch.zeros_like(att)
-        
-        for i, (att_, object_mask_) in enumerate(zip(att,object_mask)):
-            if torch.any(object_mask_):
-                alpha[i][object_mask_] = self.softmax(att_[object_mask_])    # (batch_size, num_pixels)
+        alpha = masked_softmax(att, object_mask[:att.size(0)])  # (batch_size, num_pixels)
         attention_weighted_encoding = (encoder_out * alpha.unsqueeze(2)).sum(dim=1)  # (batch_size, encoder_dim)
 
         #print(torch.topk(alpha, 4, dim=1))
@@ -1,9 +1,13 @@
 import torch
 from torch import nn
+from functools import partial
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, PackedSequence
 import numpy as np
 import torchvision
 
 from lib.config import CONF
+from models.proposal_selection import select_proposals, gather_proposals
+from models.decoding import greedy_decode, beam_search, expand_beams
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -13,13 +17,17 @@ class Decoder(nn.Module):
     Decoder.
     """
 
-    def __init__(self, vocab_list, embedding_dict, use_votenet, embed_dim=300, vote_dimension=128, encoder_dim=256, decoder_dim=512, dropout=0.5, objectness_thresh=0.75, n_closest=32):
+    def __init__(self, vocab_list, embedding_dict, use_votenet, embed_dim=300, vote_dimension=128, encoder_dim=256, decoder_dim=512, dropout=0.5, objectness_thresh=0.75, n_closest=32,
+                 beam_size=1, length_penalty=1.0, eval_scores=False):
         """
         :param embed_dim: embedding size
         :param decoder_dim: size of decoder's RNN
         :param vocab_size: size of vocabulary
         :param encoder_dim: feature size of encoded images
         :param dropout: dropout
+        :param beam_size: beam width at inference, 1 decodes greedily
+        :param length_penalty: exponent of the length normalization of beam search
+        :param eval_scores: return the scores of every greedy decoding step at inference, for a validation loss
         """
         super(Decoder, self).__init__()
 
@@ -32,6 +40,9 @@ class Decoder(nn.Module):
         self.embed_dim = embed_dim
         self.decoder_dim = decoder_dim
         self.n_closest = n_closest
+        self.beam_size = beam_size
+        self.length_penalty = length_penalty
+        self.eval_scores = eval_scores
         self.dropout = dropout
 
         print(self.__dict__)
@@ -49,7 +60,10 @@ class Decoder(nn.Module):
         self.initial_embedding = nn.Parameter(torch.tensor(embedding_dict["unk"], dtype=torch.float32, requires_grad=False).unsqueeze(0))
 
         self.dropout = nn.Dropout(p=self.dropout)
-        self.decode_step = nn.LSTMCell(self.embed_dim + self.encoder_dim, self.decoder_dim, bias=True)  # decoding LSTMCell
+        # decoding LSTM, over the packed captions in training and one step at a time at inference
+        self.decode_step = nn.LSTM(self.embed_dim + self.encoder_dim, self.decoder_dim, bias=True, batch_first=True)
+        # checkpoints of the LSTMCell decoder store decode_step.weight_ih etc.
+        self._register_load_state_dict_pre_hook(self._rename_cell_weights)
         self.init_h = nn.Linear(self.encoder_dim, self.decoder_dim)  # linear layer to find initial hidden state of LSTMCell
         self.init_c = nn.Linear(self.encoder_dim, self.decoder_dim)  # linear layer to find initial cell state of LSTMCell
         self.f_beta = nn.Linear(self.decoder_dim, self.encoder_dim)  # linear layer to create a sigmoid-activated gate
@@ -75,6 +89,25 @@ class Decoder(nn.Module):
         c = self.init_c(encoder_out)
         return h, c
 
+    def _rename_cell_weights(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        """
+        Map the LSTMCell parameters of older checkpoints to the ones of the single-layer LSTM.
+        """
+        for name in ["weight_ih", "weight_hh", "bias_ih", "bias_hh"]:
+            key = prefix + "decode_step." + name
+            if key in state_dict:
+                state_dict[key + "_l0"] = state_dict.pop(key)
+
+    def _greedy_step(self, obj_features, embedded_word, state):
+        """
+        One decoding step for greedy_decode() and beam_search(), the state is ((batch_size, decoder_dim),) * 2.
+        """
+        h, c = state
+        _, (h, c) = self.decode_step(torch.cat([embedded_word, obj_features], dim=1).unsqueeze(1), (h.unsqueeze(0), c.unsqueeze(0)))
+        h, c = h.squeeze(0), c.squeeze(0)
+
+        return self.fc(h), (h, c), None
+
     def forward(self, data_dict):
         """
         Forward propagation.
@@ -85,24 +118,17 @@ class Decoder(nn.Module):
         :return: scores for vocabulary, sorted encoded captions, decode lengths, weights, sort indices
         """
         obj_features = data_dict["ref_obj_features"]
+        # one contiguous weight buffer for cudnn, a no-op once flattened
+        self.decode_step.flatten_parameters()
 
         batch_size = obj_features.shape[0]
 
         if self.use_votenet:
-            objectness = torch.softmax(data_dict["objectness_scores"], dim=-1)[:, :, -1]
-            distance = torch.norm(data_dict["ref_center_label"].unsqueeze(1) - data_dict["aggregated_vote_xyz"], dim=2)
-            object_mask = objectness > self.objectness_thresh
-            print(torch.sum(object_mask.to(dtype=torch.int32), dim=1))
-            distance[~object_mask] = float("inf")
-            max_distances = torch.max(torch.topk(distance, self.n_closest, dim=-1, largest=False)[0], dim=1, keepdim=True)[0]
-            distance_mask = distance <= max_distances
-            object_mask &= distance_mask
-            data_dict["object_mask"] = object_mask
-            has_objects = torch.any(object_mask, dim=1)
-            # print(torch.softmax(data_dict["objectness_scores"], dim=-1))
-            vote_features = objectness.new_zeros((batch_size, self.vote_dimension))
-            if torch.any(has_objects):
-                vote_features[has_objects] = torch.stack([torch.mean(features_[object_mask_], dim=0) for features_, object_mask_ in zip(data_dict["aggregated_vote_features"][has_objects], object_mask[has_objects])])
+            proposal_inds, proposal_mask = select_proposals(data_dict, self.objectness_thresh, self.n_closest)
+            # mean over the selected proposals, zero for objects without any
+            vote_features = gather_proposals(data_dict["aggregated_vote_features"], proposal_inds)
+            weights = proposal_mask.to(dtype=vote_features.dtype).unsqueeze(2)
+            vote_features = (vote_features * weights).sum(dim=1) / weights.sum(dim=1).clamp(min=1)
             obj_features = torch.cat([vote_features, obj_features], dim=1)
         target_caption = data_dict["lang_indices"]
         target_caption_embeddings = self.idx2embedding[target_caption]
@@ -119,26 +145,21 @@ class Decoder(nn.Module):
 
             # Initialize LSTM state
             h, c = self.init_hidden_state(obj_features)  # (batch_size, decoder_dim)
-            #preds = self.fc(self.dropout(h))
-            #emb_h = self.vocabulary[preds.max(1)]
             # We won't decode at the <end> position, since we've finished generating as soon as we generate <end>
             # So, decoding lengths are actual lengths - 1
-            decode_lengths = (target_caption_lengths).tolist()
+            decode_lengths = target_caption_lengths.clamp(min=1).cpu()
 
             target_caption_embeddings = torch.cat([self.initial_embedding.unsqueeze(1).expand(batch_size, 1, -1), target_caption_embeddings], dim=1)
 
-            # Create tensors to hold word predicion scores
-            predictions = obj_features.new_zeros((batch_size, self.vocab_size, target_caption.size(1)))
-
-            # At each time-step, decode by
-            # then generate a new word in the decoder with the previous word
-            for t in range(max(decode_lengths)):
-                batch_size_t = sum([l > t for l in decode_lengths])
-                h, c = self.decode_step(
-                    torch.cat([target_caption_embeddings[:batch_size_t, t, :], obj_features[:batch_size_t,:]], dim=1),
-                    (h[:batch_size_t,:], c[:batch_size_t,:]))  # (batch_size_t, decoder_dim)
-                preds = self.fc(self.dropout(h))  # (batch_size_t, vocab_size)
-                predictions[:batch_size_t, :, t] = preds
+            # The input of a step does not depend on the previous prediction, so the whole
+            # teacher-forced sequence runs through one packed LSTM call and fc is applied once
+            max_length = int(decode_lengths[0])
+            inputs = torch.cat([target_caption_embeddings[:, :max_length], obj_features.unsqueeze(1).expand(-1, max_length, -1)], dim=2)
+            packed = pack_padded_sequence(inputs, decode_lengths, batch_first=True)
+            hiddens, _ = self.decode_step(packed, (h.unsqueeze(0), c.unsqueeze(0)))
+            preds = self.fc(self.dropout(hiddens.data))  # (sum(decode_lengths), vocab_size)
+            predictions, _ = pad_packed_sequence(PackedSequence(preds, packed.batch_sizes), batch_first=True, total_length=target_caption.size(1))
+            predictions = predictions.transpose(1, 2)  # (batch_size, vocab_size, max_caption_length)
 
             #now we need to resort the output into its initial order
             _, orig_idx = sort_ind.sort(0)
@@ -157,44 +178,18 @@ class Decoder(nn.Module):
             # predictions[:, 0] = wrd_idx
             # step = 1
 
-            predictions = obj_features.new_zeros((batch_size, CONF.TRAIN.MAX_DES_LEN), dtype=torch.int64) - 1
-            embedded_word = self.initial_embedding.expand(batch_size, -1)
-            step = 0
-
-
-            incomplete_indices = [i for i in range(batch_size)]
-
-            while True:
-                h, c = self.decode_step(
-                    torch.cat([embedded_word, obj_features[incomplete_indices]], dim=1), (h,c))
-
-                prediction = self.fc(h)
-                wrd_idx = torch.argmax(prediction, dim=1)
-                embedded_word = self.idx2embedding[wrd_idx]
-
-                predictions[incomplete_indices, step] = wrd_idx
-
-                keep_indices = wrd_idx != 0
-                h = h[keep_indices]
-                c = c[keep_indices]
-                embedded_word = embedded_word[keep_indices]
-                completed_indices = torch.nonzero(wrd_idx == 0).squeeze(-1).tolist()
-                completed_indices = [incomplete_indices[i] for i in completed_indices]
-                for c_i in completed_indices:
-                    incomplete_indices.remove(c_i)
-
-                step += 1
-                if step >= CONF.TRAIN.MAX_DES_LEN or len(incomplete_indices) == 0: # we can think about this value
-                    break
+            if self.beam_size > 1:
+                step = partial(self._greedy_step, expand_beams(obj_features, self.beam_size))
+                state = (expand_beams(h, self.beam_size), expand_beams(c, self.beam_size))
+                predictions, _, scores = beam_search(step, state, self.initial_embedding, self.idx2embedding, CONF.TRAIN.MAX_DES_LEN,
+                    self.beam_size, self.length_penalty)
+            else:
+                step = partial(self._greedy_step, obj_features)
+                predictions, _, scores = greedy_decode(step, (h, c), self.initial_embedding, self.idx2embedding, CONF.TRAIN.MAX_DES_LEN,
+                    return_scores=self.eval_scores)
 
             data_dict["caption_indices"] = predictions
-            scores = obj_features.new_zeros((batch_size, self.vocab_size, CONF.TRAIN.MAX_DES_LEN))
-
-            # tmp = torch.tensor(predictions)
-            tmp = predictions.clone().detach()
-            tmp[tmp < 0] = 0
-            scores.scatter_(1, tmp.unsqueeze(1), 1)
-
-            data_dict["caption_predictions"] = scores
+            if scores is not None:
+                data_dict["caption_predictions"] = scores
 
         return data_dict
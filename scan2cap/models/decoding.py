@@ -0,0 +1,119 @@
+import torch
+
+# steps between two checks whether every caption of the batch has ended, each check syncs with the device
+CHECK_EVERY = 4
+
+
+def greedy_decode(step, state, initial_embedding, idx2embedding, max_length, return_scores=False, check_every=CHECK_EVERY):
+    """
+    Greedy decoding of a whole batch in fixed-shape tensors.
+
+    Captions that produced <end> (index 0) keep running with the batch, a finished mask keeps their
+    later words out of the result, so the predictions match decoding every caption on its own.
+
+    :param step: step(embedded_word, state) -> (scores (batch_size, vocab_size), state, alpha or None)
+    :param state: initial decoder state, passed through step unchanged in structure
+    :param initial_embedding: (1, embed_dim) embedding fed at the first step
+    :param idx2embedding: (vocab_size, embed_dim) word embeddings
+    :param return_scores: also collect the scores of every step, e.g. for a validation loss
+    :return: word indices (batch_size, max_length), -1 after <end>,
+             attention weights (batch_size, max_length, num_proposals) or None,
+             scores (batch_size, vocab_size, max_length) or None
+    """
+    batch_size = state[0].size(0)
+    device = state[0].device
+    predictions = torch.full((batch_size, max_length), -1, dtype=torch.int64, device=device)
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    embedded_word = initial_embedding.expand(batch_size, -1)
+    alphas = None
+    all_scores = None
+
+    for t in range(max_length):
+        scores, state, alpha = step(embedded_word, state)
+        wrd_idx = torch.argmax(scores, dim=1)
+        predictions[:, t] = wrd_idx.masked_fill(finished, -1)
+        if return_scores:
+            if all_scores is None:
+                all_scores = scores.new_zeros((batch_size, scores.size(1), max_length))
+            all_scores[:, :, t] = scores
+        if alpha is not None:
+            if alphas is None:
+                alphas = alpha.new_zeros((batch_size, max_length, alpha.size(1)))
+            alphas[:, t] = alpha.masked_fill(finished.unsqueeze(1), 0)
+
+        finished |= wrd_idx == 0
+        embedded_word = idx2embedding[wrd_idx]
+        if (t + 1) % check_every == 0 and bool(finished.all()):
+            break
+
+    return predictions, alphas, all_scores
+
+
+def beam_search(step, state, initial_embedding, idx2embedding, max_length, beam_size, length_penalty=1.0, check_every=CHECK_EVERY):
+    """
+    Beam search over a whole batch, the beams are an extra batch dimension: state and every tensor
+    step closes over are laid out as (batch_size * beam_size, ...), see expand_beams().
+
+    Beams that produced <end> keep their score and only extend with <end>. Hypotheses are ranked
+    by their log probability divided by length ** length_penalty (length including <end>).
+
+    :param step: step(embedded_word, state) -> (scores (batch_size * beam_size, vocab_size), state, alpha or None)
+    :return: word indices of the best beam (batch_size, max_length), -1 after <end>,
+             its attention weights (batch_size, max_length, num_proposals) or None,
+             None in place of the scores of greedy_decode(), they are not tracked per beam
+    """
+    batch_size = state[0].size(0) // beam_size
+    device = state[0].device
+    predictions = torch.full((batch_size, beam_size, max_length), -1, dtype=torch.int64, device=device)
+    finished = torch.zeros((batch_size, beam_size), dtype=torch.bool, device=device)
+    lengths = torch.zeros((batch_size, beam_size), device=device)
+    # all beams start identical, only the first one is expanded at the first step
+    beam_scores = torch.full((batch_size, beam_size), float("-inf"), device=device)
+    beam_scores[:, 0] = 0
+    embedded_word = initial_embedding.expand(batch_size * beam_size, -1)
+    batch_offsets = torch.arange(batch_size, device=device).unsqueeze(1) * beam_size
+    alphas = None
+
+    for t in range(max_length):
+        scores, state, alpha = step(embedded_word, state)
+        log_probs = torch.log_softmax(scores, dim=1).view(batch_size, beam_size, -1)
+        vocab_size = log_probs.size(2)
+        # finished beams extend with <end> at no cost
+        end_only = torch.full_like(log_probs[0, 0], float("-inf"))
+        end_only[0] = 0
+        log_probs = torch.where(finished.unsqueeze(2), end_only, log_probs)
+
+        beam_scores, candidates = torch.topk((beam_scores.unsqueeze(2) + log_probs).view(batch_size, -1), beam_size, dim=1)
+        parents = candidates // vocab_size
+        wrd_idx = candidates % vocab_size
+
+        # reorder everything to the surviving beams
+        flat_parents = (batch_offsets + parents).view(-1)
+        state = tuple(s[flat_parents] for s in state)
+        predictions = torch.gather(predictions, 1, parents.unsqueeze(2).expand(-1, -1, max_length))
+        parent_finished = torch.gather(finished, 1, parents)
+        lengths = torch.gather(lengths, 1, parents) + (~parent_finished).float()
+        predictions[:, :, t] = wrd_idx.masked_fill(parent_finished, -1)
+        if alpha is not None:
+            if alphas is None:
+                alphas = alpha.new_zeros((batch_size, beam_size, max_length, alpha.size(1)))
+            alphas = torch.gather(alphas, 1, parents.view(batch_size, beam_size, 1, 1).expand_as(alphas))
+            alphas[:, :, t] = alpha[flat_parents].view(batch_size, beam_size, -1).masked_fill(parent_finished.unsqueeze(2), 0)
+
+        finished = parent_finished | (wrd_idx == 0)
+        embedded_word = idx2embedding[wrd_idx.view(-1)]
+        if (t + 1) % check_every == 0 and bool(finished.all()):
+            break
+
+    best = torch.argmax(beam_scores / lengths.clamp(min=1) ** length_penalty, dim=1)
+    batch_inds = torch.arange(batch_size, device=device)
+    alphas = alphas[batch_inds, best] if alphas is not None else None
+
+    return predictions[batch_inds, best], alphas, None
+
+
+def expand_beams(tensor, beam_size):
+    """
+    Repeat every sample of a per-sample tensor beam_size times, (batch_size, ...) -> (batch_size * beam_size, ...).
+    """
+    return tensor.repeat_interleave(beam_size, dim=0)
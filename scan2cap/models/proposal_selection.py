@@ -0,0 +1,32 @@
+import torch
+
+
+def select_proposals(data_dict, objectness_thresh, n_closest):
+    """
+    The n_closest votenet proposals to the target object that pass the objectness threshold,
+    gathered into a compact tensor so the decoders never touch the other proposals.
+
+    Also stores the (batch_size, num_proposals) "object_mask" of the selection in data_dict.
+
+    :return: indices of the selected proposals (batch_size, n_closest), sorted by distance,
+             and their validity mask (batch_size, n_closest), padding slots are False
+    """
+    objectness = torch.softmax(data_dict["objectness_scores"], dim=-1)[:, :, -1]
+    distance = torch.norm(data_dict["ref_center_label"].unsqueeze(1) - data_dict["aggregated_vote_xyz"], dim=2)
+    distance = distance.masked_fill(objectness <= objectness_thresh, float("inf"))
+
+    # proposals below the threshold are at infinity, they only fill slots if there are fewer than n_closest objects
+    closest, proposal_inds = torch.topk(distance, n_closest, dim=-1, largest=False)
+    proposal_mask = closest < float("inf")
+    data_dict["object_mask"] = torch.zeros_like(distance, dtype=torch.bool).scatter_(1, proposal_inds, proposal_mask)
+
+    return proposal_inds, proposal_mask
+
+
+def gather_proposals(features, proposal_inds):
+    """
+    :param features: (batch_size, num_proposals, C) per-proposal tensor
+    :param proposal_inds: (batch_size, K) from select_proposals()
+    :return: (batch_size, K, C) features of the selected proposals
+    """
+    return torch.gather(features, 1, proposal_inds.unsqueeze(2).expand(-1, -1, features.size(2)))
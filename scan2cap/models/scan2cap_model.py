@@ -1,3 +1,4 @@
+import torch
 from torch import nn
 
 from models.baseline_captioning_module import Decoder
@@ -5,11 +6,44 @@ from models.pointnet_extractor_module import PointNetExtractor
 from models.votenet_wrapper_module import VoteNetWrapperModule
 from models.attention_captioning import Attentive_Decoder
 
+# per-object entries the decoders and the caption loss read
+REFERENCE_KEYS = ["ref_obj_features", "aggregated_vote_features", "aggregated_vote_xyz", "objectness_scores",
+    "ref_center_label", "other_lang_indices"]
+
+
+def run_encoders(data_dict, pn_extractor, votenet_extractor=None):
+    """
+    Encoder half of Scan2CapModel.forward(), shared with the frozen-encoder worker of lib/encoder_pipeline.py.
+    Encoders whose outputs are already in data_dict are skipped.
+    """
+    scene_inds = data_dict.pop("scene_inds", None)
+    if scene_inds is not None:
+        # batch from SceneBatchSampler, one point cloud per scene sample
+        scene_point_clouds = data_dict["point_clouds"]
+        data_dict["point_clouds"] = scene_point_clouds[scene_inds]
+
+    # batches of CachedFeatureDataset already carry the outputs of the frozen encoders
+    if "ref_obj_features" not in data_dict:
+        data_dict = pn_extractor(data_dict)
+    if votenet_extractor is not None and "aggregated_vote_features" not in data_dict:
+        if scene_inds is not None:
+            # run votenet once per scene sample and fan its outputs out to the objects of the batch
+            scene_dict = votenet_extractor({"point_clouds": scene_point_clouds})
+            for key, value in scene_dict.items():
+                if key != "point_clouds" and torch.is_tensor(value):
+                    data_dict[key] = value[scene_inds]
+        else:
+            data_dict = votenet_extractor(data_dict)
+
+    return data_dict
+
 
 class Scan2CapModel(nn.Module):
-    def __init__(self, vocab_list, embedding_dict, feature_channels=0, use_votenet=False, use_attention=False, objectness_thresh=.75, n_closest=32):
+    def __init__(self, vocab_list, embedding_dict, feature_channels=0, use_votenet=False, use_attention=False, objectness_thresh=.75, n_closest=32, multi_ref=False,
+                 beam_size=1, length_penalty=1.0, eval_scores=False):
         super().__init__()
         self.feature_channels = feature_channels
+        self.multi_ref = multi_ref
         self.use_votenet = use_votenet
         self.use_attention = use_attention
 
@@ -19,19 +53,40 @@ class Scan2CapModel(nn.Module):
             # Only use xyz + height for now, because pretrained model does not use color or normal info
             self.votenet_extractor = VoteNetWrapperModule(input_feature_dim=1)
             if self.use_attention:
-                self.decoder = Attentive_Decoder(vocab_list=vocab_list, embedding_dict=embedding_dict, objectness_thresh=objectness_thresh, n_closest=n_closest)
+                self.decoder = Attentive_Decoder(vocab_list=vocab_list, embedding_dict=embedding_dict, objectness_thresh=objectness_thresh, n_closest=n_closest,
+                    beam_size=beam_size, length_penalty=length_penalty, eval_scores=eval_scores)
         if not self.use_attention:
-            self.decoder = Decoder(vocab_list=vocab_list, embedding_dict=embedding_dict, use_votenet=self.use_votenet, objectness_thresh=objectness_thresh, n_closest=n_closest)
+            self.decoder = Decoder(vocab_list=vocab_list, embedding_dict=embedding_dict, use_votenet=self.use_votenet, objectness_thresh=objectness_thresh, n_closest=n_closest,
+                beam_size=beam_size, length_penalty=length_penalty, eval_scores=eval_scores)
         if self.use_attention and not self.use_votenet:
             raise Exception("Attention can't be used without votenet") 
         
     def forward(self, data_dict):
-        data_dict = self.pn_extractor(data_dict)
-        if self.use_votenet:
-            data_dict = self.votenet_extractor(data_dict) 
+        data_dict = run_encoders(data_dict, self.pn_extractor, self.votenet_extractor if self.use_votenet else None)
+        if self.multi_ref and self.training:
+            data_dict = self._fan_out_references(data_dict)
         data_dict = self.decoder(data_dict)
         return data_dict
 
+    def _fan_out_references(self, data_dict):
+        """
+        One sample per object (see Scan2CapDataset(multi_ref=True)): repeat the encoder outputs for every
+        description of the object in other_lang_indices, which become the teacher-forced targets.
+        The caption loss is then averaged over all descriptions of the batch.
+        """
+        other_lang_lens = data_dict["other_lang_lens"]
+        valid = other_lang_lens > 0
+        ref_inds = torch.nonzero(valid)[:, 0]
+
+        data_dict["lang_indices"] = data_dict["other_lang_indices"][valid]
+        data_dict["lang_len"] = other_lang_lens[valid]
+        for key in REFERENCE_KEYS:
+            if key in data_dict:
+                data_dict[key] = data_dict[key][ref_inds]
+        data_dict["ref_inds"] = ref_inds
+
+        return data_dict
+
     def load_pn_extractor(self, state_dict):
         self.pn_extractor.load_state_dict(state_dict)
 
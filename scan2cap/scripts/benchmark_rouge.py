@@ -0,0 +1,69 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.getcwd()))  # HACK add the root folder
+from utils.pycocoevalcap.rouge.rouge import Rouge
+from utils.token_scorer import TokenScorer
+from utils.tokens import detokenize, compact_tokens
+
+
+def random_batch(args, rng):
+    """
+    Hypotheses and references like the ones of caption_metrics: word indices, <end> (0) and -1 padding,
+    some references are missing (all padding) and some hypotheses are empty.
+    """
+    def sentences(shape):
+        indices = rng.integers(1, args.vocab_size, size=shape + (args.max_len,))
+        lengths = rng.integers(0, args.max_len, size=shape)
+        positions = np.arange(args.max_len)
+        indices[positions >= lengths[..., None]] = -1
+        indices[positions == lengths[..., None]] = 0
+        return indices
+
+    return sentences((args.batch_size,)), sentences((args.batch_size, args.num_refs))
+
+
+def benchmark(args):
+    rng = np.random.default_rng(args.seed)
+    # a small vocabulary makes common subsequences likely
+    vocabulary = ["<end>"] + ["w{}".format(i) for i in range(1, args.vocab_size)]
+
+    string_time = 0
+    token_time = 0
+    for _ in range(args.iterations):
+        hypo, refs = random_batch(args, rng)
+
+        start = time.time()
+        hypotheses = {"{}".format(i): [sentence] for i, sentence in enumerate(detokenize(hypo, vocabulary))}
+        references = {"{}".format(i): list(sentences) for i, sentences in enumerate(detokenize(refs, vocabulary))}
+        string_score, string_scores = Rouge().compute_score(references, hypotheses)
+        string_time += time.time() - start
+
+        start = time.time()
+        hypo_tokens, hypo_lengths = compact_tokens(hypo)
+        ref_tokens, ref_lengths = compact_tokens(refs)
+        token_score, token_scores = TokenScorer(hypo_tokens, hypo_lengths, ref_tokens, ref_lengths, len(vocabulary)).rouge()
+        token_time += time.time() - start
+
+        if token_score != string_score or not np.array_equal(token_scores, string_scores):
+            raise AssertionError("ROUGE-L differs: {} (tokens) vs. {} (strings)".format(token_score, string_score))
+
+    print("{} batches of {} x {} references, identical scores".format(args.iterations, args.batch_size, args.num_refs))
+    print("strings: {:.2f} ms per batch".format(string_time / args.iterations * 1000))
+    print("tokens:  {:.2f} ms per batch (includes the n-gram counts of the scorer)".format(token_time / args.iterations * 1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, help="batches to score [default: 200]", default=200)
+    parser.add_argument("--batch_size", type=int, help="hypotheses per batch [default: 16]", default=16)
+    parser.add_argument("--num_refs", type=int, help="references per hypothesis [default: 5]", default=5)
+    parser.add_argument("--max_len", type=int, help="word indices per sentence [default: 30]", default=30)
+    parser.add_argument("--vocab_size", type=int, help="words of the random sentences [default: 20]", default=20)
+    parser.add_argument("--seed", type=int, help="random seed [default: 0]", default=0)
+    args = parser.parse_args()
+
+    benchmark(args)
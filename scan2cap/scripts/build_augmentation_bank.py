@@ -0,0 +1,58 @@
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.getcwd()))  # HACK add the root folder
+from lib.config import CONF
+from lib.scene_store import SceneStore
+from lib.augmentation_bank import write_bank
+from lib.scan2cap_dataset import MULTIVIEW_DATA
+
+
+def get_scene_list(args):
+    scene_list = set()
+    for split in args.splits:
+        scanrefer = json.load(open(os.path.join(CONF.PATH.DATA, "ScanRefer_filtered_{}.json".format(split))))
+        scene_list |= set([data["scene_id"] for data in scanrefer])
+
+    return sorted(list(scene_list))
+
+
+def build(args):
+    np.random.seed(args.seed)
+
+    scene_list = get_scene_list(args)
+    columns = ["xyz", "rgb"] + (["color"] if args.use_color else []) + (["normal"] if args.use_normal else [])
+    scene_store = SceneStore(scene_list, archive_path=args.scene_archive, columns=columns, lazy=True, cache_bytes=0)
+
+    print("writing {} variants of {} scenes to {}...".format(args.num_variants, len(scene_list), args.output))
+    write_bank(args.output, scene_store, args.num_variants,
+        num_points=args.num_points,
+        use_color=args.use_color,
+        use_normal=args.use_normal,
+        use_height=(not args.no_height),
+        multiview_path=MULTIVIEW_DATA if args.use_multiview else None,
+        augment=(not args.no_augment)
+    )
+    print("done!")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, help="Output folder of the bank.", required=True)
+    parser.add_argument("--splits", type=str, nargs="+", help="ScanRefer splits whose scenes are written [default: train]", default=["train"])
+    parser.add_argument("--num_variants", type=int, help="Number of variants per scene [default: 8]", default=8)
+    parser.add_argument("--seed", type=int, help="Random seed [default: 42]", default=42)
+    parser.add_argument('--num_points', type=int, default=40000, help='Point Number [default: 40000]')
+    parser.add_argument('--no_height', action='store_true', help='Do NOT use height signal in input.')
+    parser.add_argument('--no_augment', action='store_true', help='Only sample, do NOT augment the variants.')
+    parser.add_argument('--use_color', action='store_true', help='Use RGB color in input.')
+    parser.add_argument('--use_normal', action='store_true', help='Use RGB color in input.')
+    parser.add_argument('--use_multiview', action='store_true', help='Use multiview images.')
+    parser.add_argument('--scene_archive', type=str, help='Read scenes from a consolidated archive (see data/scannet/scannet_archive.py).', default=None)
+    args = parser.parse_args()
+
+    build(args)
@@ -0,0 +1,31 @@
+import argparse
+import json
+import os
+import sys
+
+sys.path.append(os.path.join(os.getcwd()))  # HACK add the root folder
+from lib.config import CONF
+from lib.document_frequency import write_document_frequency
+
+
+def get_scanrefers(args):
+    return [json.load(open(os.path.join(CONF.PATH.DATA, "ScanRefer_filtered_{}.json".format(split)))) for split in args.splits]
+
+
+def build(args):
+    scanrefers = get_scanrefers(args)
+    vocabulary = ["<end>"] + json.load(open(os.path.join(CONF.PATH.DATA, "vocabulary.json"), "r"))
+
+    print("counting the {}-gram document frequencies of {} descriptions to {}...".format(args.n, sum([len(s) for s in scanrefers]), args.output))
+    write_document_frequency(args.output, scanrefers, vocabulary, n=args.n)
+    print("done!")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, help="Output file of the document frequencies.", required=True)
+    parser.add_argument("--splits", type=str, nargs="+", help="ScanRefer splits whose descriptions are counted [default: train val]", default=["train", "val"])
+    parser.add_argument("--n", type=int, help="Longest n-gram, the one of CIDEr [default: 4]", default=4)
+    args = parser.parse_args()
+
+    build(args)
@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+import pickle
+import sys
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.getcwd()))  # HACK add the root folder
+from lib.config import CONF
+from lib.scan2cap_dataset import Scan2CapDataset
+from lib.feature_cache import write_feature_cache
+from models.scan2cap_model import Scan2CapModel
+
+GLOVE_PICKLE = os.path.join(CONF.PATH.DATA, "glove.p")
+VOCABULARY = json.load(open(os.path.join(CONF.PATH.DATA, "vocabulary.json"), "r"))
+VOCABULARY = ["<end>"] + VOCABULARY
+
+
+def get_model(args):
+    with open(GLOVE_PICKLE, "rb") as f:
+        glove = pickle.load(f)
+    input_channels = int(args.use_multiview) * 128 + int(args.use_normal) * 3 + int(args.use_color) * 3 + int(
+        not args.no_height)
+    model = Scan2CapModel(vocab_list=VOCABULARY, embedding_dict=glove, feature_channels=input_channels,
+        use_votenet=args.use_votenet).cuda()
+    del glove
+
+    model.load_pn_extractor(torch.load(args.pnextractor_cp))
+    if args.use_votenet:
+        model.load_votenet(torch.load(args.votenet_cp)["model_state_dict"])
+
+    return model
+
+
+def build(args):
+    np.random.seed(args.seed)
+    model = get_model(args)
+
+    for split in args.splits:
+        scanrefer = json.load(open(os.path.join(CONF.PATH.DATA, "ScanRefer_filtered_{}.json".format(split))))
+        # only the training split is augmented, one variant suffices for the others
+        augment = split == "train" and not args.no_augment
+        dataset = Scan2CapDataset(
+            scanrefer=scanrefer,
+            scanrefer_all_scene=[],
+            vocabulary=VOCABULARY,
+            split=split,
+            num_points=args.num_points,
+            use_height=(not args.no_height),
+            use_color=args.use_color,
+            use_normal=args.use_normal,
+            use_multiview=args.use_multiview,
+            augment=augment,
+            scene_archive=args.scene_archive,
+            augment_bank=args.augment_bank if split == "train" else None,
+            multi_ref=True
+        )
+
+        path = os.path.join(args.output, split)
+        num_variants = args.num_variants if augment or dataset.bank is not None else 1
+        print("caching {} variants of {} objects to {}...".format(num_variants, len(dataset), path))
+        write_feature_cache(path, model, dataset, num_variants, batch_size=args.batch_size, seed=args.seed)
+
+    print("done!")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, help="Output folder of the cache, one subfolder per split.", required=True)
+    parser.add_argument("--splits", type=str, nargs="+", help="ScanRefer splits to cache [default: train val]", default=["train", "val"])
+    parser.add_argument("--num_variants", type=int, help="Number of augmented variants per training object [default: 8]", default=8)
+    parser.add_argument("--seed", type=int, help="Random seed [default: 42]", default=42)
+    parser.add_argument("--gpu", type=str, help="gpu", default="0")
+    parser.add_argument("--batch_size", type=int, help="batch size", default=16)
+    parser.add_argument('--num_points', type=int, default=40000, help='Point Number [default: 40000]')
+    parser.add_argument('--no_height', action='store_true', help='Do NOT use height signal in input.')
+    parser.add_argument('--no_augment', action='store_true', help='Do NOT use augmentation in input.')
+    parser.add_argument('--use_color', action='store_true', help='Use RGB color in input.')
+    parser.add_argument('--use_normal', action='store_true', help='Use RGB color in input.')
+    parser.add_argument('--use_multiview', action='store_true', help='Use multiview images.')
+    parser.add_argument('--scene_archive', type=str, help='Read scenes from a consolidated archive (see data/scannet/scannet_archive.py).', default=None)
+    parser.add_argument('--augment_bank', type=str, help='Draw training samples from a pre-augmented bank (see scripts/build_augmentation_bank.py).', default=None)
+    parser.add_argument('--pnextractor_cp', type=str, help="Checkpoint location for pointnet extractor.", required=True)
+    parser.add_argument('--votenet_cp', type=str, help="Checkpoint location for votenet extractor.", default=None)
+    parser.add_argument('--use_votenet', action='store_true', help="Cache votenet features as well. (Required for attention)")
+    args = parser.parse_args()
+
+    if args.use_votenet and args.votenet_cp is None:
+        parser.error("--use_votenet needs --votenet_cp")
+
+    # setting
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+
+    build(args)
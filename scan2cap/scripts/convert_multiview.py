@@ -0,0 +1,37 @@
+import argparse
+import json
+import os
+import sys
+
+sys.path.append(os.path.join(os.getcwd()))  # HACK add the root folder
+from lib.config import CONF
+from lib.multiview_store import write_multiview_store
+from lib.scan2cap_dataset import MULTIVIEW_DATA
+
+
+def get_scene_list(args):
+    scene_list = set()
+    for split in args.splits:
+        scanrefer = json.load(open(os.path.join(CONF.PATH.DATA, "ScanRefer_filtered_{}.json".format(split))))
+        scene_list |= set([data["scene_id"] for data in scanrefer])
+
+    return sorted(list(scene_list))
+
+
+def convert(args):
+    scene_list = get_scene_list(args)
+
+    print("converting the multiview features of {} scenes to {}...".format(len(scene_list), args.output))
+    write_multiview_store(args.output, scene_list, args.multiview, quantize=args.quantize)
+    print("done!")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, help="Output file of the store.", required=True)
+    parser.add_argument("--multiview", type=str, help="Multiview features to convert [default: enet_feats.hdf5]", default=MULTIVIEW_DATA)
+    parser.add_argument("--splits", type=str, nargs="+", help="ScanRefer splits whose scenes are converted [default: train val]", default=["train", "val"])
+    parser.add_argument("--quantize", action="store_true", help="Store the features as float16.")
+    args = parser.parse_args()
+
+    convert(args)
@@ -13,6 +13,7 @@ sys.path.append(os.path.join(os.getcwd()))
 from lib.scan2cap_dataset import Scan2CapDataset
 from lib.scannet_cls_dataset import ScannetPretrainDataset
 from lib.solver_pretrain import SolverPretrain
+from lib.augmentation import BatchAugmentation
 from models.pointnet_extractor_module import PointNetExtractor
 
 # HACK add the root folder
@@ -41,6 +42,7 @@ def get_dataloader(args, scanrefer, all_scene_list, split, config, augment):
             use_normal=args.use_normal,
             use_multiview=args.use_multiview,
             augment=augment,
+            augment_bank=args.augment_bank if split == "train" else None,
             class_weights=CLASS_WEIGHTS if not args.no_class_weight else None
         )
     else:
@@ -53,7 +55,8 @@ def get_dataloader(args, scanrefer, all_scene_list, split, config, augment):
             use_color=args.use_color,
             use_normal=args.use_normal,
             use_multiview=args.use_multiview,
-            augment=augment
+            augment=augment,
+            augment_bank=args.augment_bank if split == "train" else None
         )
     # dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True)
     dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=4, drop_last=True)
@@ -76,7 +79,8 @@ def get_num_params(model):
 def get_solver(args, dataloader, stamp):
     model = get_model(args)
     optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.wd)
-    solver = SolverPretrain(model, DC, dataloader, optimizer, stamp, args.val_step, early_stopping=args.es)
+    solver = SolverPretrain(model, DC, dataloader, optimizer, stamp, args.val_step, early_stopping=args.es,
+        augmentation=BatchAugmentation() if args.device_augment else None)
     num_params = get_num_params(model)
 
     return solver, num_params
@@ -128,7 +132,7 @@ def train(args):
     }
 
     # dataloader
-    train_dataset, train_dataloader = get_dataloader(args, scanrefer, all_scene_list, "train", DC, True)
+    train_dataset, train_dataloader = get_dataloader(args, scanrefer, all_scene_list, "train", DC, not args.device_augment)
 
     val_dataset, val_dataloader = get_dataloader(args, scanrefer, all_scene_list, "val", DC, False)
     
@@ -163,9 +167,11 @@ if __name__ == "__main__":
     parser.add_argument('--num_scenes', type=int, default=-1, help='Number of scenes [default: -1]')
     parser.add_argument('--no_height', action='store_true', help='Do NOT use height signal in input.')
     parser.add_argument('--no_augment', action='store_true', help='Do NOT use augmentation in input.')
+    parser.add_argument('--device_augment', action='store_true', help='Augment whole batches on the gpu instead of per sample in the workers.')
     parser.add_argument('--use_color', action='store_true', help='Use RGB color in input.')
     parser.add_argument('--use_normal', action='store_true', help='Use RGB color in input.')
     parser.add_argument('--use_multiview', action='store_true', help='Use multiview images.')
+    parser.add_argument('--augment_bank', type=str, help='Draw training samples from a pre-augmented bank (see scripts/build_augmentation_bank.py).', default=None)
     parser.add_argument("--scannet", action="store_true", help="Use raw Scannet instead of ScanRefer for pretraining.")
     parser.add_argument("--no_class_weight", action="store_true", help="Don't use class weights in pretraining.")
     args = parser.parse_args()
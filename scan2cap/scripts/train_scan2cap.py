@@ -8,11 +8,14 @@ from datetime import datetime
 import numpy as np
 import torch
 import torch.optim as optim
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, RandomSampler
 
 sys.path.append(os.path.join(os.getcwd()))  # HACK add the root folder
 from lib.scan2cap_dataset import Scan2CapDataset
 from lib.solver_captioning import SolverCaptioning
+from lib.scene_store import ScenePrefetchSampler, SceneBatchSampler, collate_scene_batch
+from lib.augmentation import BatchAugmentation
+from lib.feature_cache import CachedFeatureDataset
 from models.scan2cap_model import Scan2CapModel
 
 
@@ -31,6 +34,14 @@ DC = ScannetDatasetConfig()
 
 
 def get_dataloader(args, scanrefer, all_scene_list, split, config, augment):
+    if args.feature_cache is not None:
+        # decoder-only training on the cached outputs of the frozen encoders
+        dataset = CachedFeatureDataset(scanrefer[split], VOCABULARY, os.path.join(args.feature_cache, split),
+            multi_ref=args.multi_ref and split == "train")
+        dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=4, drop_last=True)
+
+        return dataset, dataloader
+
     dataset = Scan2CapDataset(
         scanrefer=scanrefer[split],
         scanrefer_all_scene=all_scene_list,
@@ -41,10 +52,26 @@ def get_dataloader(args, scanrefer, all_scene_list, split, config, augment):
         use_color=args.use_color,
         use_normal=args.use_normal,
         use_multiview=args.use_multiview,
-        augment=augment
+        augment=augment,
+        scene_archive=args.scene_archive,
+        lazy_scenes=args.lazy_scenes,
+        scene_cache_bytes=args.scene_cache_mb * 1024 ** 2,
+        multiview_store=args.multiview_store,
+        augment_bank=args.augment_bank if split == "train" else None,
+        multi_ref=args.multi_ref and split == "train"
     )
     # dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True)
-    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=4, drop_last=True)
+    if args.scene_batches and split == "train":
+        # samples of the same scene share one sampled and augmented point cloud per batch
+        stride = args.batch_size * 4 if args.lazy_scenes else None
+        batch_sampler = SceneBatchSampler(dataset.get_scene_ids(), args.batch_size, samples_per_scene=args.samples_per_scene, stride=stride)
+        dataloader = DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_scene_batch, num_workers=4)
+    elif args.lazy_scenes:
+        # point every worker at the scenes of its next batch
+        sampler = ScenePrefetchSampler(RandomSampler(dataset), stride=args.batch_size * 4)
+        dataloader = DataLoader(dataset, batch_size=args.batch_size, sampler=sampler, num_workers=4, drop_last=True)
+    else:
+        dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=4, drop_last=True)
 
     return dataset, dataloader
 
@@ -56,7 +83,8 @@ def get_model(args):
     input_channels = int(args.use_multiview) * 128 + int(args.use_normal) * 3 + int(args.use_color) * 3 + int(
         not args.no_height)
     model = Scan2CapModel(vocab_list=VOCABULARY, embedding_dict=glove, feature_channels=input_channels, 
-        use_votenet=args.use_votenet, use_attention=args.use_attention, objectness_thresh=args.objectness_thresh, n_closest=args.n_closest).cuda()
+        use_votenet=args.use_votenet, use_attention=args.use_attention, objectness_thresh=args.objectness_thresh, n_closest=args.n_closest,
+        multi_ref=args.multi_ref, beam_size=args.beam_size, length_penalty=args.length_penalty, eval_scores=args.val_loss).cuda()
     del glove
     return model
 
@@ -73,7 +101,10 @@ def get_solver(args, dataloader, stamp):
     model = get_model(args)
     optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.wd)
     vocabulary = VOCABULARY 
-    solver = SolverCaptioning(model, DC, dataloader, optimizer, stamp, vocabulary, args.use_attention, args.val_step , early_stopping=args.es, only_val=args.only_val,gradient_clip=args.gradient_clip)
+    solver = SolverCaptioning(model, DC, dataloader, optimizer, stamp, vocabulary, args.use_attention, args.val_step , early_stopping=args.es, only_val=args.only_val,gradient_clip=args.gradient_clip,
+        augmentation=BatchAugmentation() if args.device_augment else None, pipeline=args.encoder_pipeline,
+        metric_step={"train": args.train_metric_step, "val": args.val_metric_step}, metric_workers=args.metric_workers,
+        cider_document_frequency=args.cider_df)
     if args.pnextractor_cp is not None:
         pnextractor_cp = torch.load(args.pnextractor_cp)
         model.load_pn_extractor(pnextractor_cp)
@@ -146,7 +177,7 @@ def train(args):
     }
 
     # dataloader
-    train_dataset, train_dataloader = get_dataloader(args, scanrefer, all_scene_list, "train", DC, True)
+    train_dataset, train_dataloader = get_dataloader(args, scanrefer, all_scene_list, "train", DC, not args.device_augment)
 
     val_dataset, val_dataloader = get_dataloader(args, scanrefer, all_scene_list, "val", DC, False)
 
@@ -175,6 +206,10 @@ if __name__ == "__main__":
     parser.add_argument("--epoch", type=int, help="number of epochs", default=200)
     parser.add_argument("--verbose", type=int, help="iterations of showing verbose", default=1)
     parser.add_argument("--val_step", type=int, help="iterations of validating", default=2500)
+    parser.add_argument("--train_metric_step", type=int, help="iterations between caption metrics in training, 0 disables them", default=1)
+    parser.add_argument("--val_metric_step", type=int, help="iterations between caption metrics in validation, at least 1 (bleu4 selects the best model)", default=1)
+    parser.add_argument("--metric_workers", type=int, help="processes computing the caption metrics in the background, 0 computes them in place", default=0)
+    parser.add_argument("--cider_df", type=str, help="corpus CIDEr document frequencies (see scripts/build_document_frequency.py), default counts them per batch", default=None)
     parser.add_argument("--lr", type=float, help="learning rate", default=1e-3)
     parser.add_argument("--wd", type=float, help="weight decay", default=0.0)
     parser.add_argument("--es", type=float, help="early stop", default=-1)
@@ -182,9 +217,20 @@ if __name__ == "__main__":
     parser.add_argument('--num_scenes', type=int, default=-1, help='Number of scenes [default: -1]')
     parser.add_argument('--no_height', action='store_true', help='Do NOT use height signal in input.')
     parser.add_argument('--no_augment', action='store_true', help='Do NOT use augmentation in input.')
+    parser.add_argument('--device_augment', action='store_true', help='Augment whole batches on the gpu instead of per sample in the workers.')
     parser.add_argument('--use_color', action='store_true', help='Use RGB color in input.')
     parser.add_argument('--use_normal', action='store_true', help='Use RGB color in input.')
     parser.add_argument('--use_multiview', action='store_true', help='Use multiview images.')
+    parser.add_argument('--multiview_store', type=str, help='Read multiview features from a converted store (see scripts/convert_multiview.py).', default=None)
+    parser.add_argument('--scene_archive', type=str, help='Read scenes from a consolidated archive (see data/scannet/scannet_archive.py).', default=None)
+    parser.add_argument('--lazy_scenes', action='store_true', help='Load scenes on demand through an LRU cache instead of all at startup.')
+    parser.add_argument('--scene_cache_mb', type=int, default=4096, help='Scene cache budget per worker in lazy mode [default: 4096]')
+    parser.add_argument('--scene_batches', action='store_true', help='Group training samples of the same scene, run votenet once per scene.')
+    parser.add_argument('--samples_per_scene', type=int, default=None, help='Max. samples sharing one scene point cloud [default: batch size]')
+    parser.add_argument('--multi_ref', action='store_true', help='Train on objects instead of descriptions, encode each object once and decode all of its descriptions.')
+    parser.add_argument('--augment_bank', type=str, help='Draw training samples from a pre-augmented bank (see scripts/build_augmentation_bank.py).', default=None)
+    parser.add_argument('--feature_cache', type=str, help='Train the decoder on cached encoder outputs (see scripts/cache_backbone_features.py).', default=None)
+    parser.add_argument('--encoder_pipeline', action='store_true', help='Run the frozen encoders in a separate process, overlapped with decoder training.')
     parser.add_argument('--pnextractor_cp', type=str, help="Checkpoint location for pointnet extractor.", default=None)
     parser.add_argument('--votenet_cp', type=str, help="Checkpoint location for votenet extractor.", default=None)
     parser.add_argument('--decoder_cp', type=str, help="Checkpoint location for LSTM decoder.", default=None)
@@ -194,9 +240,25 @@ if __name__ == "__main__":
     parser.add_argument('--use_attention', action='store_true', help="Use attention for captioning, only works if votenet is used")
     parser.add_argument('--objectness_thresh', type=float, help="Threshold for accepting objects proposed by votenet", default=.75)
     parser.add_argument('--n_closest', type=int, help="Number of n closest votenet proposals are considered", default=32)
+    parser.add_argument('--beam_size', type=int, help="Beam width for decoding at inference, 1 decodes greedily", default=1)
+    parser.add_argument('--length_penalty', type=float, help="Exponent of the length normalization of beam search", default=1.0)
+    parser.add_argument('--val_loss', action='store_true', help="Compute the validation loss, the decoder then also returns its scores at inference")
     parser.add_argument('--gradient_clip', type=float, help="Clip gradients", default=None)
     args = parser.parse_args()
 
+    # the bank variants are augmented already
+    if args.device_augment and (args.no_augment or args.augment_bank is not None):
+        parser.error("--device_augment cannot be combined with --no_augment or --augment_bank")
+    # beam search returns no scores to compute the loss on
+    if args.val_loss and args.beam_size > 1:
+        parser.error("--val_loss cannot be combined with --beam_size > 1")
+    # cached batches carry encoder outputs only, no point clouds or scenes
+    if args.feature_cache is not None:
+        scene_flags = ["device_augment", "augment_bank", "scene_batches", "lazy_scenes", "use_multiview", "encoder_pipeline"]
+        used = ["--" + flag for flag in scene_flags if getattr(args, flag) not in (None, False)]
+        if used:
+            parser.error("--feature_cache cannot be combined with {}".format(", ".join(used)))
+
     # setting
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
     os.environ["CUDA_LAUNCH_BLOCKING"] = "1"
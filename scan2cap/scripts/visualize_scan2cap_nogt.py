@@ -15,6 +15,7 @@ from models.scan2cap_model import Scan2CapModel
 sys.path.append(os.path.join(os.getcwd())) # HACK add the root folder
 from utils.pc_utils import write_ply_rgb
 from utils.box_util import get_3d_box
+from utils.tokens import detokenize
 from data.scannet.model_util_scannet import ScannetDatasetConfig
 from lib.config import CONF
 from lib.scan2cap_dataset import Scan2CapDataset
@@ -57,7 +58,8 @@ def get_model(args):
     # initiate model
     input_channels = int(args.use_multiview) * 128 + int(args.use_normal) * 3 + int(args.use_color) * 3 + int(
         not args.no_height)
-    model = Scan2CapModel(vocab_list=VOCABULARY, embedding_dict=glove, feature_channels=input_channels, use_votenet=args.use_votenet, use_attention=args.use_attention, objectness_thresh=args.objectness_thresh, n_closest=args.n_closest).cuda()
+    model = Scan2CapModel(vocab_list=VOCABULARY, embedding_dict=glove, feature_channels=input_channels, use_votenet=args.use_votenet, use_attention=args.use_attention, objectness_thresh=args.objectness_thresh, n_closest=args.n_closest,
+        beam_size=args.beam_size, length_penalty=args.length_penalty).cuda()
     path = os.path.join(CONF.PATH.OUTPUT, args.folder, "model.pth")
     # path = os.path.join(CONF.PATH.OUTPUT, args.folder, "model_last.pth")
     model.load_state_dict(torch.load(path), strict=False)
@@ -347,6 +349,7 @@ def dump_results(args, scanrefer, data, config):
 
     nyu40_label = torch.argmax(data["ref_obj_cls_scores"], dim=1).detach().cpu().numpy() + 1
     hypo = data["caption_indices"]
+    hypo_sentences = detokenize(hypo, VOCABULARY)
 
     for i in range(batch_size):
         # basic info
@@ -367,7 +370,7 @@ def dump_results(args, scanrefer, data, config):
 
             write_ply_rgb(point_clouds[i], pcl_color[i], os.path.join(scene_dump_dir, 'pc.ply'))
 
-        hypo_strings = ' '.join([VOCABULARY[index] for index in hypo[i] if index > 0])
+        hypo_strings = hypo_sentences[i]
 
         print("Hypo", hypo_strings)
 
@@ -503,6 +506,8 @@ if __name__ == "__main__":
     parser.add_argument('--use_attention', action='store_true', help="Use attention for captioning, only works if votenet is used")
     parser.add_argument('--objectness_thresh', type=float, help="Threshold for accepting objects proposed by votenet", default=.75)
     parser.add_argument('--n_closest', type=int, help="Number of n closest votenet proposals are considered", default=8)
+    parser.add_argument('--beam_size', type=int, help="Beam width for decoding at inference, 1 decodes greedily", default=1)
+    parser.add_argument('--length_penalty', type=float, help="Exponent of the length normalization of beam search", default=1.0)
     parser.add_argument('--cp', type=str, help="Checkpoint location for Scan2Cap model.", default=None)
     args = parser.parse_args()
 
@@ -0,0 +1,334 @@
+"""
+BLEU, CIDEr and ROUGE-L straight from word indices.
+
+Same scores as Bleu(n), Cider(n) and Rouge() of pycocoevalcap on the detokenized sentences, but
+the n-grams are int64 keys counted with numpy for the whole batch instead of tuples of strings
+counted in dicts, sentence by sentence, and the longest common subsequences are bit-parallel over
+all pairs instead of a python table per pair. Every float is computed with the operations of the
+string scorers and sums are added in their order, so the scores are equal to the last bit, not only close.
+"""
+
+import math
+import numpy as np
+
+from utils.pycocoevalcap.rouge.rouge import my_lcs
+
+
+def ngram_keys(tokens, lengths, n, vocab_size):
+    """
+    Keys of all 1..n-grams of every sentence, the k-gram of words w_0 .. w_k-1 has the key
+    (k - 1) * vocab_size ** n + sum_j w_j * vocab_size ** j, unique over all orders.
+
+    :param tokens: (S, T) word indices, the words at the front of each row, see utils.tokens.compact_tokens()
+    :param lengths: (S,) number of words of each row
+    :return: (S, K) int64 keys and their (S, K) validity mask, columns ordered by order then position
+    """
+    if n * vocab_size ** n >= 2 ** 63:
+        raise ValueError("{}-gram keys of {} words overflow int64".format(n, vocab_size))
+
+    tokens = np.asarray(tokens, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    num_words = tokens.shape[1]
+    keys = []
+    valid = []
+    for k in range(1, n + 1):
+        width = max(num_words - k + 1, 0)
+        order_keys = np.full((tokens.shape[0], width), (k - 1) * vocab_size ** n, dtype=np.int64)
+        for j in range(k):
+            order_keys += tokens[:, j:j + width] * vocab_size ** j
+        keys.append(order_keys)
+        valid.append(np.arange(width)[None, :] < (lengths[:, None] - k + 1))
+
+    return np.concatenate(keys, axis=1), np.concatenate(valid, axis=1)
+
+
+def _segment_sum(values, segments, ranks, num_segments):
+    """
+    Sums of values per segment, added rank after rank like the loops of the string scorers.
+    """
+    sums = np.zeros(num_segments)
+    for rank in range(ranks.max() + 1 if ranks.size > 0 else 0):
+        at = ranks == rank
+        # every segment has at most one value of each rank
+        sums[segments[at]] += values[at]
+
+    return sums
+
+
+def _popcount(values):
+    return np.unpackbits(values.astype("<u8").view(np.uint8)).reshape(-1, 64).sum(axis=1).astype(np.int64)
+
+
+def lcs_lengths(a, a_lengths, b, b_lengths):
+    """
+    Lengths of the longest common subsequences of the rows of a and b, with the bit-parallel
+    algorithm of Allison-Dix / Hyyro: the shorter row of a pair is a bit vector in one uint64,
+    every word of the longer row updates it with a few bit operations, for all pairs at once.
+    Pairs of two rows longer than 64 words fall back to my_lcs().
+
+    :param a: (P, T) word indices, the words at the front of each row
+    :param a_lengths: (P,)
+    :param b: (P, T') word indices, the words at the front of each row
+    :param b_lengths: (P,)
+    :return: (P,) int64
+    """
+    a_lengths = np.asarray(a_lengths, dtype=np.int64)
+    b_lengths = np.asarray(b_lengths, dtype=np.int64)
+    num_words = max(a.shape[1], b.shape[1])
+    a = np.pad(np.asarray(a, dtype=np.int64), ((0, 0), (0, num_words - a.shape[1])))
+    b = np.pad(np.asarray(b, dtype=np.int64), ((0, 0), (0, num_words - b.shape[1])))
+
+    # the shorter row of every pair is the bit vector
+    swap = a_lengths > b_lengths
+    pattern = np.where(swap[:, None], b, a)
+    pattern_lengths = np.where(swap, b_lengths, a_lengths)
+    text = np.where(swap[:, None], a, b)
+    text_lengths = np.where(swap, a_lengths, b_lengths)
+    long_pairs = pattern_lengths > 64
+    pattern = pattern[:, :64]
+
+    positions = np.arange(pattern.shape[1])
+    bits = np.left_shift(np.uint64(1), positions.astype(np.uint64))
+    # bit i of match[p, j] is set if word i of the pattern equals word j of the text
+    equal = (pattern[:, :, None] == text[:, None, :]) & (positions[None, :, None] < pattern_lengths[:, None, None])
+    match = np.bitwise_or.reduce(np.where(equal, bits[None, :, None], np.uint64(0)), axis=1)
+
+    v = np.full(pattern.shape[0], np.iinfo(np.uint64).max, dtype=np.uint64)
+    for j in range(text.shape[1]):
+        u = v & match[:, j]
+        v = np.where(j < text_lengths, (v + u) | (v - u), v)
+
+    # the zero bits of v within the pattern are the common subsequence
+    low = np.left_shift(np.uint64(1), np.minimum(pattern_lengths, 63).astype(np.uint64)) - np.uint64(1)
+    low = np.where(pattern_lengths >= 64, np.iinfo(np.uint64).max, low).astype(np.uint64)
+    lengths = _popcount(~v & low)
+
+    for p in np.flatnonzero(long_pairs):
+        lengths[p] = my_lcs(a[p, :a_lengths[p]].tolist(), b[p, :b_lengths[p]].tolist())
+
+    return lengths
+
+
+def _lookup(table_codes, table_values, codes):
+    """
+    table_values at the positions of codes in the sorted table_codes, 0 for missing codes.
+    """
+    if table_codes.size == 0:
+        return np.zeros(codes.shape, dtype=table_values.dtype)
+    inds = np.minimum(np.searchsorted(table_codes, codes), table_codes.size - 1)
+
+    return np.where(table_codes[inds] == codes, table_values[inds], 0)
+
+
+class TokenScorer():
+    """
+    n-gram counts of one hypothesis and R references per image, shared by bleu() and cider().
+
+    Words are the indices > 0 of a row, the same words detokenize() joins into a sentence.
+    """
+
+    def __init__(self, hypotheses, hypothesis_lengths, references, reference_lengths, vocab_size, n=4):
+        """
+        :param hypotheses: (B, T) word indices, words at the front, see utils.tokens.compact_tokens()
+        :param hypothesis_lengths: (B,)
+        :param references: (B, R, T') word indices, words at the front
+        :param reference_lengths: (B, R)
+        :param vocab_size: number of words in the vocabulary
+        """
+        self.n = n
+        self.vocab_size = vocab_size
+        self.hypotheses = hypotheses
+        self.references = references
+        self.num_images, self.num_refs = references.shape[:2]
+        self.hypothesis_lengths = np.asarray(hypothesis_lengths, dtype=np.int64)
+        self.reference_lengths = np.asarray(reference_lengths, dtype=np.int64)
+
+        # one table of sentences, the hypotheses first and then the references image by image
+        num_words = max(hypotheses.shape[1], references.shape[2])
+        tokens = np.zeros((self.num_images * (1 + self.num_refs), num_words), dtype=np.int64)
+        tokens[:self.num_images, :hypotheses.shape[1]] = hypotheses
+        tokens[self.num_images:, :references.shape[2]] = references.reshape(-1, references.shape[2])
+        lengths = np.concatenate([self.hypothesis_lengths, self.reference_lengths.reshape(-1)])
+
+        keys, valid = ngram_keys(tokens, lengths, n, vocab_size)
+        orders = np.concatenate([np.full(max(num_words - k + 1, 0), k) for k in range(1, n + 1)])
+        # row-major, so per sentence in the order precook() meets the n-grams
+        sentence = np.broadcast_to(np.arange(tokens.shape[0])[:, None], keys.shape)[valid]
+        order = np.broadcast_to(orders[None, :], keys.shape)[valid]
+        self.keys, ngram = np.unique(keys[valid], return_inverse=True)
+        ngram = ngram.reshape(-1)
+
+        # one entry per distinct n-gram of a sentence, in the insertion order of the precook() dicts
+        _, first, counts = np.unique(sentence * self.keys.size + ngram, return_index=True, return_counts=True)
+        insertion = np.argsort(first)
+        first = first[insertion]
+        self._sentence = sentence[first]
+        self._ngram = ngram[first]
+        self._order = order[first]
+        self._count = counts[insertion]
+
+        # position of every entry among the n-grams of its sentence and order
+        segment = self._sentence * n + self._order - 1
+        self._rank = np.arange(segment.size) - np.searchsorted(segment, segment)
+
+    def _references(self):
+        """
+        Mask of the reference entries and the image of each of them.
+        """
+        is_ref = self._sentence >= self.num_images
+
+        return is_ref, (self._sentence[is_ref] - self.num_images) // self.num_refs
+
+    def bleu(self):
+        """
+        Same as Bleu(n).compute_score(), the closest reference length is the effective one.
+
+        :return: corpus BLEU-1..n and the per-image BLEU-1..n lists
+        """
+        n = self.n
+        small = 1e-9
+        tiny = 1e-15
+        num_images = self.num_images
+        num_ngrams = self.keys.size
+
+        # highest count of every n-gram over the references of an image
+        is_ref, ref_image = self._references()
+        ref_codes, ref_inverse = np.unique(ref_image * num_ngrams + self._ngram[is_ref], return_inverse=True)
+        max_counts = np.zeros(ref_codes.size, dtype=np.int64)
+        np.maximum.at(max_counts, ref_inverse.reshape(-1), self._count[is_ref])
+
+        is_hyp = ~is_ref
+        hyp_image = self._sentence[is_hyp]
+        clipped = np.minimum(self._count[is_hyp], _lookup(ref_codes, max_counts, hyp_image * num_ngrams + self._ngram[is_hyp]))
+        correct = np.zeros((num_images, n), dtype=np.int64)
+        np.add.at(correct, (hyp_image, self._order[is_hyp] - 1), clipped)
+
+        testlens = self.hypothesis_lengths
+        guess = np.maximum(0, testlens[:, None] - np.arange(n)[None, :])
+        # closest reference length, the shorter one on ties
+        distance = np.abs(self.reference_lengths - testlens[:, None])
+        closest = np.argmin(distance * (self.reference_lengths.max(initial=0) + 1) + self.reference_lengths, axis=1)
+        reflens = self.reference_lengths[np.arange(num_images), closest]
+
+        bleu_list = [[] for _ in range(n)]
+        for testlen, reflen, image_correct, image_guess in zip(testlens.tolist(), reflens.tolist(), correct.tolist(), guess.tolist()):
+            bleu = 1.
+            for k in range(n):
+                bleu *= (float(image_correct[k]) + tiny) / (float(image_guess[k]) + small)
+                bleu_list[k].append(bleu ** (1. / (k + 1)))
+            ratio = (testlen + tiny) / (reflen + small)
+            if ratio < 1:
+                for k in range(n):
+                    bleu_list[k][-1] *= math.exp(1 - 1 / ratio)
+
+        total_testlen = int(testlens.sum())
+        total_reflen = int(reflens.sum())
+        total_correct = correct.sum(axis=0).tolist()
+        total_guess = guess.sum(axis=0).tolist()
+        bleus = []
+        bleu = 1.
+        for k in range(n):
+            bleu *= float(total_correct[k] + tiny) / (total_guess[k] + small)
+            bleus.append(bleu ** (1. / (k + 1)))
+        ratio = (total_testlen + tiny) / (total_reflen + small)
+        if ratio < 1:
+            for k in range(n):
+                bleus[k] *= math.exp(1 - 1 / ratio)
+
+        return bleus, bleu_list
+
+    def cider(self, sigma=6.0, document_frequency=None):
+        """
+        Same as Cider(n, sigma).compute_score(), the document frequencies are counted over the references of the batch.
+
+        :param document_frequency: corpus document frequencies (lib.document_frequency.DocumentFrequency) used instead
+                                   of the batch ones, the reference length is then the log of the corpus size
+        :return: mean CIDEr and the (B,) array of per-image CIDEr
+        """
+        n = self.n
+        num_images = self.num_images
+        num_refs = self.num_refs
+        num_ngrams = self.keys.size
+
+        # number of images whose references contain each n-gram
+        is_ref, ref_image = self._references()
+        if document_frequency is None:
+            document_frequency = np.bincount(np.unique(ref_image * num_ngrams + self._ngram[is_ref]) % num_ngrams, minlength=num_ngrams)
+            ref_len = np.log(float(num_images)) if num_images > 1 else 1
+        else:
+            if document_frequency.n != n or document_frequency.vocab_size != self.vocab_size:
+                raise ValueError("document frequencies of {}-grams over {} words do not match {}-grams over {} words".format(
+                    document_frequency.n, document_frequency.vocab_size, n, self.vocab_size))
+            ref_len = np.log(float(document_frequency.num_documents))
+            document_frequency = document_frequency(self.keys)
+
+        # tf-idf of every entry, the norms per sentence and order, the lengths count bigrams like CiderScorer
+        vec = self._count.astype(np.float64) * (ref_len - np.log(np.maximum(1.0, document_frequency[self._ngram].astype(np.float64))))
+        num_sentences = num_images * (1 + num_refs)
+        norm = np.sqrt(_segment_sum(vec * vec, self._sentence * n + self._order - 1, self._rank, num_sentences * n)).reshape(-1, n)
+        lengths = np.concatenate([self.hypothesis_lengths, self.reference_lengths.reshape(-1)])
+        length = np.maximum(lengths - 1, 0) if n > 1 else np.zeros_like(lengths)
+
+        # clipped products of the hypothesis entries with the same n-gram of every reference
+        ref_codes = self._sentence[is_ref] * num_ngrams + self._ngram[is_ref]
+        ref_sort = np.argsort(ref_codes)
+        is_hyp = ~is_ref
+        hyp_image = self._sentence[is_hyp]
+        hyp_vec = vec[is_hyp][:, None]
+        ref_sentence = num_images + hyp_image[:, None] * num_refs + np.arange(num_refs)[None, :]
+        ref_vec = _lookup(ref_codes[ref_sort], vec[is_ref][ref_sort], ref_sentence * num_ngrams + self._ngram[is_hyp][:, None])
+        segments = (hyp_image[:, None] * num_refs + np.arange(num_refs)[None, :]) * n + self._order[is_hyp][:, None] - 1
+        ranks = np.broadcast_to(self._rank[is_hyp][:, None], segments.shape)
+        val = _segment_sum((np.minimum(hyp_vec, ref_vec) * ref_vec).reshape(-1), segments.reshape(-1), ranks.reshape(-1), num_images * num_refs * n)
+        val = val.reshape(num_images, num_refs, n)
+
+        norm_hyp = norm[:num_images, None, :]
+        norm_ref = norm[num_images:].reshape(num_images, num_refs, n)
+        nonzero = (norm_hyp != 0) & (norm_ref != 0)
+        val = np.divide(val, norm_hyp * norm_ref, out=val, where=nonzero)
+        assert not np.isnan(val).any()
+
+        # gaussian length penalty, with the python float power of CiderScorer
+        delta = length[:num_images, None] - length[num_images:].reshape(num_images, num_refs)
+        deltas, inverse = np.unique(delta, return_inverse=True)
+        penalties = np.array([np.e ** (-(float(d) ** 2) / (2 * sigma ** 2)) for d in deltas.tolist()])
+        val *= penalties[inverse.reshape(delta.shape)][:, :, None]
+
+        score = np.zeros((num_images, n))
+        for r in range(num_refs):
+            score += val[:, r]
+        scores = []
+        for image_score in score:
+            score_avg = np.mean(image_score)
+            score_avg /= num_refs
+            score_avg *= 10.0
+            scores.append(score_avg)
+
+        return np.mean(np.array(scores)), np.array(scores)
+
+    def rouge(self, beta=1.2):
+        """
+        Same as Rouge().compute_score().
+
+        :return: mean ROUGE-L and the (B,) array of per-image ROUGE-L
+        """
+        num_images = self.num_images
+        num_refs = self.num_refs
+
+        # Rouge splits the sentences on " ", an empty sentence is one empty word that only matches another empty sentence
+        hypothesis_lengths = np.maximum(self.hypothesis_lengths, 1)
+        reference_lengths = np.maximum(self.reference_lengths, 1)
+        hypotheses = np.where(np.arange(self.hypotheses.shape[1])[None, :] < self.hypothesis_lengths[:, None], self.hypotheses, 0)
+        references = np.where(np.arange(self.references.shape[2])[None, None, :] < self.reference_lengths[:, :, None], self.references, 0)
+
+        lcs = lcs_lengths(np.repeat(hypotheses, num_refs, axis=0), np.repeat(hypothesis_lengths, num_refs),
+                          references.reshape(num_images * num_refs, -1), reference_lengths.reshape(-1))
+        lcs = lcs.reshape(num_images, num_refs)
+        prec_max = (lcs / hypothesis_lengths[:, None].astype(np.float64)).max(axis=1)
+        rec_max = (lcs / reference_lengths.astype(np.float64)).max(axis=1)
+
+        scores = np.zeros(num_images)
+        nonzero = (prec_max != 0) & (rec_max != 0)
+        scores[nonzero] = ((1 + beta**2) * prec_max[nonzero] * rec_max[nonzero]) / (rec_max[nonzero] + beta**2 * prec_max[nonzero])
+
+        return np.mean(scores), scores
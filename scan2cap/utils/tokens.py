@@ -0,0 +1,58 @@
+import numpy as np
+import torch
+
+
+def detokenize(indices, vocabulary):
+    """
+    Sentences of a batch of word indices, same as ' '.join([vocabulary[index] for index in row if index > 0])
+    for every row, but with a single copy to the host and a table lookup for all words at once.
+
+    :param indices: (..., T) tensor or array, <end> is index 0 and padding -1
+    :param vocabulary: list of words, or an object array of them
+    :return: object array of strings, shape indices.shape[:-1]
+    """
+    if torch.is_tensor(indices):
+        indices = indices.detach().cpu().numpy()
+    table = vocabulary if isinstance(vocabulary, np.ndarray) else np.array(vocabulary, dtype=object)
+
+    words = table[np.maximum(indices, 0)]
+    keep = indices > 0
+    # rows that end at their first <end> or padding are cut there, the others are filtered word by word
+    lengths = np.where(keep.all(axis=-1), indices.shape[-1], np.argmax(~keep, axis=-1))
+    prefix = keep.sum(axis=-1) == lengths
+
+    flat_words = words.reshape(-1, indices.shape[-1])
+    flat_keep = keep.reshape(-1, indices.shape[-1])
+    sentences = np.empty(flat_words.shape[0], dtype=object)
+    for i, (length, is_prefix) in enumerate(zip(lengths.reshape(-1), prefix.reshape(-1))):
+        sentences[i] = " ".join(flat_words[i, :length] if is_prefix else flat_words[i][flat_keep[i]])
+
+    return sentences.reshape(indices.shape[:-1])
+
+
+def count_tokens(indices, tokens):
+    """
+    Occurrences of any of tokens in every row of indices, with a single copy to the host.
+    """
+    if torch.is_tensor(indices):
+        indices = indices.detach().cpu().numpy()
+
+    return np.isin(indices, tokens).sum(axis=-1)
+
+
+def compact_tokens(indices):
+    """
+    Words of every row moved to the front, as the sentences of detokenize() split them:
+    all indices > 0 in their order.
+
+    :param indices: (..., T) tensor or array
+    :return: (..., T) int64 array of word indices, 0 after the words, and (...) lengths
+    """
+    if torch.is_tensor(indices):
+        indices = indices.detach().cpu().numpy()
+
+    keep = indices > 0
+    order = np.argsort(~keep, axis=-1, kind="stable")
+    tokens = np.take_along_axis(np.where(keep, indices, 0), order, axis=-1).astype(np.int64)
+
+    return tokens, keep.sum(axis=-1)